@@ -268,6 +268,8 @@ in python310Packages.buildPythonPackage {
     wrapProgram $out/bin/json-hafas-stationboard.pl --set PERL5LIB ${hafasperl}
     wrapProgram $out/bin/json-db-composition.pl --set PERL5LIB ${hafasperl}
     wrapProgram $out/bin/json-hafas-dbris-stopfinder.pl --set PERL5LIB ${hafasperl}
+    wrapProgram $out/bin/json-hafas-stopfinder.pl --set PERL5LIB ${hafasperl}
+    wrapProgram $out/bin/json-hafas-worker.pl --set PERL5LIB ${hafasperl}
   '';
 
   propagatedBuildInputs = (with python310Packages; [
@@ -0,0 +1,32 @@
+#!/usr/bin/env perl
+
+use strict;
+use warnings;
+
+use JSON;
+use Travel::Status::DE::HAFAS;
+
+# ./json-hafas-stopfinder.pl SERVICE NAME
+
+my $hafas = Travel::Status::DE::HAFAS->new(
+	service => $ARGV[0],
+	locationSearch => $ARGV[1]
+);
+if (my @results = $hafas->results) {
+	my @ret;
+	foreach my $stop (@results) {
+		push(@ret, {
+			name => $stop->name,
+			eva => $stop->eva,
+		});
+	}
+
+	print encode_json({
+		stops=>[@ret]
+	});
+} else {
+	print encode_json({
+		error_code => $hafas->errcode,
+		error_string => $hafas->errstr
+	});
+}
@@ -0,0 +1,73 @@
+#!/usr/bin/env perl
+
+use strict;
+use warnings;
+
+# long-lived worker for the other json-*.pl scripts, so perl and the Travel::Status
+# modules only get loaded once instead of on every single request.
+# reads one request per line from stdin: {"script": "json-hafas.pl", "args": [...]}
+# runs the script in-process and prints whatever it printed as a single line to stdout.
+
+BEGIN {
+	# the scripts exit when they're done, make that return control to us instead
+	*CORE::GLOBAL::exit = sub { die "json-hafas-worker exit\n" };
+}
+
+use File::Basename;
+use JSON;
+use DateTime;
+use Travel::Status::DE::DBRIS;
+use Travel::Status::DE::HAFAS;
+use Travel::Status::DE::EFA;
+use Travel::Status::MOTIS;
+
+my %scripts = map { $_ => 1 } qw(
+	json-db-composition.pl
+	json-hafas.pl
+	json-hafas-stationboard.pl
+	json-hafas-stopfinder.pl
+);
+my $dir = dirname(__FILE__);
+
+sub script_path {
+	my ($script) = @_;
+	# nix' wrapProgram moves the actual script out of the way
+	if (-e "$dir/.$script-wrapped") {
+		return "$dir/.$script-wrapped";
+	}
+	return "$dir/$script";
+}
+
+$| = 1;
+while (my $line = <STDIN>) {
+	my $request = eval { decode_json($line) };
+	if (not $request or not $scripts{$request->{script} // ''}) {
+		print encode_json({error_string => 'invalid worker request'}) . "\n";
+		next;
+	}
+
+	my $path = script_path($request->{script});
+	my $output = '';
+	{
+		local @ARGV = @{$request->{args} // []};
+		local $SIG{__WARN__} = sub {
+			# scripts with subs redefine them every time we run them, that's fine
+			warn @_ unless $_[0] =~ /^Subroutine \w+ redefined/;
+		};
+		open(my $fh, '>', \$output);
+		my $stdout = select($fh);
+		do $path;
+		my $err = $@;
+		select($stdout);
+		close($fh);
+
+		if ($err and $err ne "json-hafas-worker exit\n") {
+			warn "$request->{script} broke: $err";
+			if (not length $output) {
+				$output = encode_json({error_string => "$request->{script} broke: $err"});
+			}
+		}
+	}
+	$output =~ s/\n/ /g;
+	print "$output\n";
+}
@@ -0,0 +1,7 @@
+-- what the ÖBB stop finder found for stations ÖBB HAFAS doesn't know by their usual ID,
+-- so we only have to ask it once. eva is NULL if it found nothing.
+CREATE TABLE oebb_stopfinder (
+	name TEXT PRIMARY KEY,
+	eva INTEGER,
+	found_at INTEGER NOT NULL
+);
@@ -0,0 +1,11 @@
+-- indexes for the lookups we do all the time
+-- trips by journey_id alone is already covered by its primary key
+CREATE INDEX idx_trips_user ON trips(user_id);
+CREATE INDEX idx_trips_failedhafas ON trips(user_id) WHERE hafas_data ->> '$.failedhafas';
+CREATE INDEX idx_messages_journey ON messages(user_id, journey_id, channel_id);
+CREATE INDEX idx_messages_channel ON messages(user_id, channel_id, message_id);
+CREATE INDEX idx_messages_id ON messages(message_id);
+CREATE INDEX idx_links_long_url ON links(long_url);
+CREATE INDEX idx_oebb_stations_name ON oebb_stations(name);
+CREATE INDEX idx_cts_stops_name ON cts_stops(name);
+CREATE INDEX idx_trams_network ON trams(network COLLATE NOCASE);
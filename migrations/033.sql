@@ -0,0 +1,6 @@
+-- keep the status with the user's edits applied around instead of patching it on every read
+ALTER TABLE trips ADD COLUMN patched_status TEXT;
+UPDATE trips SET patched_status = json_patch(travelynx_status, status_patch);
+ALTER TABLE trips ADD COLUMN departure INTEGER
+	GENERATED ALWAYS AS (patched_status ->> '$.fromStation.realTime') VIRTUAL;
+CREATE INDEX idx_trips_departure ON trips(user_id, departure);
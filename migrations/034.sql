@@ -0,0 +1,12 @@
+-- polylines live here instead of in hafas_data. points are packed float32 lat/lon pairs,
+-- distances the float64 km from the first point to each point, stops a json list of
+-- [index, eva, name] for the points that have either.
+CREATE TABLE polylines (
+	journey_id TEXT NOT NULL,
+	user_id INTEGER NOT NULL,
+	points BLOB NOT NULL,
+	distances BLOB NOT NULL,
+	stops TEXT NOT NULL,
+	PRIMARY KEY (journey_id, user_id)
+);
+CREATE INDEX idx_polylines_user ON polylines(user_id);
@@ -0,0 +1,3 @@
+-- the network format.get_network() found for the current version of the trip, NULL
+-- until we've worked it out again after the status changed
+ALTER TABLE trips ADD COLUMN network TEXT;
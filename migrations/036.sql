@@ -0,0 +1,5 @@
+-- trips by user_id is covered by idx_trips_departure from 033 now
+DROP INDEX idx_trips_user;
+-- the startup retry of failed hafas lookups goes by departure, not by user
+DROP INDEX idx_trips_failedhafas;
+CREATE INDEX idx_trips_failedhafas ON trips(from_time) WHERE hafas_data ->> '$.failedhafas';
@@ -0,0 +1,74 @@
+"""how much latency the shared http session saves per request, compared to opening a new
+ClientSession for every request like we used to. a check-in does a handful of those
+(token check, composition scrapers, the loopback posts), so multiply accordingly.
+
+without a url this asks a local server, which only shows what setting up the connector and
+the tcp connection costs. give it a https url to see dns and tls handshakes as well:
+    python -m tests.bench_http_session [url] [requests]
+"""
+import asyncio
+import sys
+import time
+
+from aiohttp import ClientSession, web
+
+from . import environment  # pylint: disable=unused-import
+from travelhook import helpers  # pylint: disable=wrong-import-order
+
+
+async def local_server():
+    async def hello(_request):
+        return web.Response(text="hi")
+
+    app = web.Application()
+    app.router.add_get("/", hello)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+async def session_per_request(url, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        async with ClientSession() as session:
+            async with session.get(url) as r:
+                await r.read()
+    return time.perf_counter() - start
+
+
+async def shared_session(url, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        async with helpers.get_session().get(url) as r:
+            await r.read()
+    return time.perf_counter() - start
+
+
+async def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else None
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    runner = None
+    if not url:
+        runner, url = await local_server()
+
+    try:
+        # warm up both, the first request of the shared session opens its connection
+        await session_per_request(url, 1)
+        await shared_session(url, 1)
+        separate = await session_per_request(url, requests)
+        shared = await shared_session(url, requests)
+    finally:
+        await helpers.close_session()
+        if runner:
+            await runner.cleanup()
+
+    print(f"{requests} requests to {url}")
+    print(f"session per request: {separate * 1000 / requests:8.2f} ms per request")
+    print(f"shared session:      {shared * 1000 / requests:8.2f} ms per request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,32 @@
+"""how long finding the network takes through network_index, against the chain of checks
+get_network used to be. uses the same made up cases as test_networks:
+    python -m tests.bench_networks [cases]
+"""
+import sys
+import time
+
+from .environment import F
+from .test_networks import cases, chain_network
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    statuses = list(cases(count))
+
+    start = time.perf_counter()
+    for status, operator in statuses:
+        chain_network(status, operator)
+    chain = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for status, _ in statuses:
+        F.get_network(status, {})
+    index = time.perf_counter() - start
+
+    print(f"{count} cases")
+    print(f"chain of checks: {chain * 1e6 / count:6.2f} µs per lookup")
+    print(f"network_index:   {index * 1e6 / count:6.2f} µs per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""how much the perl worker pool saves over starting perl for every request, which is what
+fetch_hafas_data and friends used to do. the requests ask for a backend service that doesn't
+exist, so this runs without network access and only measures what the pool is about:
+starting perl and loading the Travel::Status modules.
+
+run it from the repository root, with the Travel::Status modules installed:
+    python -m tests.bench_perl_workers [requests]
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from .environment import DB, root
+
+ARGS = ("NOSUCHSERVICE", "Karlsruhe Hbf")
+
+
+def spawn_per_call(requests):
+    for _ in range(requests):
+        subprocess.run(
+            [os.path.join(root, "json-hafas-stopfinder.pl"), *ARGS],
+            capture_output=True,
+            check=False,
+        )
+
+
+async def worker_pool(requests):
+    pool = DB.PerlWorkerPool(2, 30)
+    # the first request on a worker starts it, that's what we're trying to not do all the time
+    await asyncio.gather(
+        *(pool.request("json-hafas-stopfinder.pl", *ARGS) for _ in range(2))
+    )
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(pool.request("json-hafas-stopfinder.pl", *ARGS) for _ in range(requests))
+    )
+    elapsed = time.perf_counter() - start
+    for worker in pool.idle:
+        worker.kill()
+        await worker.wait()
+    return elapsed
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    os.environ["PATH"] = root + os.pathsep + os.environ["PATH"]
+
+    start = time.perf_counter()
+    spawn_per_call(requests)
+    spawned = time.perf_counter() - start
+    # the workers inherit our stderr and complain about the made up service on every request
+    stderr = os.dup(2)
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        os.dup2(devnull.fileno(), 2)
+    try:
+        pooled = asyncio.run(worker_pool(requests))
+    finally:
+        os.dup2(stderr, 2)
+
+    print(f"{requests} requests")
+    print(f"spawn per call: {spawned * 1000 / requests:8.2f} ms per request")
+    print(f"worker pool:    {pooled * 1000 / requests:8.2f} ms per request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""webhook-sized bursts of writes with sqlite's default settings, the way the bot used to open
+its database, against the tuning profile from connect(). a burst is what a checkin writes:
+the trip, its hafas data and polyline, a status patch and the live feed message.
+the database lives in the temporary directory, point TMPDIR at the disk the bot runs on:
+    python -m tests.bench_sqlite_tuning [bursts]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from .environment import DB, migrate, settings
+
+PROFILES = {
+    "defaults": {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "mmap_size": 0,
+        "cache_size": -2000,
+        "busy_timeout": 5000,
+        "cached_statements": 128,
+    },
+    "tuned": settings["sqlite"],
+}
+
+
+def status(i):
+    departure = 1700000000 + i * 600
+    return {
+        "checkedIn": True,
+        "comment": "",
+        "visibility": {"desc": "public"},
+        "backend": {"type": "HAFAS", "name": "DB", "id": 1},
+        "train": {"type": "S", "line": "3", "no": str(i), "id": f"1|{i}|0|80|0"},
+        "fromStation": {
+            "name": "Karlsruhe Hbf",
+            "uic": 8000191,
+            "latitude": 48.99,
+            "longitude": 8.40,
+            "scheduledTime": departure,
+            "realTime": departure,
+        },
+        "toStation": {
+            "name": "Mannheim Hbf",
+            "uic": 8000244,
+            "latitude": 49.48,
+            "longitude": 8.47,
+            "scheduledTime": departure + 3600,
+            "realTime": departure + 3600,
+        },
+    }
+
+
+def hafas_data(i):
+    return {
+        "id": f"1|{i}|0|80|0",
+        "headsign": "Mannheim Hbf",
+        "beeline": False,
+        "route": [{"name": f"stop {n}", "eva": 8000000 + n} for n in range(30)],
+        "polyline": [
+            {"lat": 48.99 + n / 1000, "lon": 8.40 + n / 2000, "eva": None, "name": None}
+            for n in range(500)
+        ],
+    }
+
+
+def burst(i):
+    DB.Trip.upsert(42, status(i))
+    trip = DB.Trip.find(42, DB.zugid(status(i)))
+    trip.save_hafas_data(hafas_data(i))
+    trip.patch_patch({"composition": "2x 423"})
+    DB.Message(trip.journey_id, 42, 1, 1000 + i).write()
+
+
+def run(profile, bursts):
+    path = os.path.join(tempfile.mkdtemp(), "travelynx-relay.sqlite3")
+    migrate(path)
+    settings["sqlite"] = profile
+    DB.connect(path)
+    DB.User(42, "s", "w", None, 0, "", True, "Europe/Berlin").write()
+    start = time.perf_counter()
+    for i in range(bursts):
+        burst(i)
+    return time.perf_counter() - start
+
+
+def main():
+    bursts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{bursts} bursts")
+    for name, profile in PROFILES.items():
+        elapsed = run(profile, bursts)
+        print(f"{name:10} {elapsed * 1000 / bursts:8.2f} ms per burst")
+
+
+if __name__ == "__main__":
+    main()
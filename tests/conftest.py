@@ -0,0 +1,75 @@
+"fixtures shared by the tests"
+import copy
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+from . import environment, journey
+
+
+@pytest.fixture(scope="session")
+def migrated_database(tmp_path_factory):
+    "a database with all migrations applied, copied by the tests that want one"
+    path = tmp_path_factory.mktemp("migrated") / "travelynx-relay.sqlite3"
+    environment.migrate(path)
+    return path
+
+
+@pytest.fixture
+def db(migrated_database, tmp_path):
+    "travelhook's database module, connected to a fresh database of our own"
+    path = tmp_path / "travelynx-relay.sqlite3"
+    shutil.copy(migrated_database, path)
+    environment.DB.connect(str(path))
+    # users cached from another test's database don't exist in this one
+    environment.DB.user_cache.invalidate(*environment.DB.user_cache.entries)
+    return environment.DB
+
+
+class Bot:
+    "as much of a discord bot as rendering needs: the emoji servers and the users"
+
+    def __init__(self):
+        names = {
+            name
+            for tt in environment.F.train_types_config["train_types"]
+            for name in tt["emoji"].split("|")
+        }
+        self.emojis = [Emoji(name) for name in sorted(names)]
+
+    def get_guild(self, _guild_id):
+        return SimpleNamespace(emojis=self.emojis)
+
+    def get_user(self, user_id):
+        return SimpleNamespace(
+            id=user_id,
+            name=f"user{user_id}",
+            avatar=SimpleNamespace(url=f"https://example.org/avatars/{user_id}.png"),
+        )
+
+
+class Emoji(SimpleNamespace):
+    def __init__(self, name):
+        super().__init__(name=name)
+
+    def __str__(self):
+        return f"<:{self.name}:1>"
+
+
+@pytest.fixture
+def bot():
+    return Bot()
+
+
+@pytest.fixture
+def trips(db):
+    "the trips of the journey in journey.py, in a database of their own"
+    db.User(**journey.USER).write()
+    for status, hafas_data in journey.TRIPS:
+        db.Trip.upsert(journey.USER["discord_id"], status)
+        with db.DB.transaction():
+            db.Trip.find(journey.USER["discord_id"], db.zugid(status)).save_hafas_data(
+                copy.deepcopy(hafas_data)
+            )
+    return db.Trip.find_current_trips_for(journey.USER["discord_id"])
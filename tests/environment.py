@@ -0,0 +1,47 @@
+"""travelhook reads settings.json and train_types.toml from the working directory as soon as
+it's imported. this gives it a scratch directory with both, so the tests and benchmarks can
+import it from anywhere, and sets up scratch databases with all the migrations applied."""
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+workdir = tempfile.mkdtemp(prefix="travelhook-")
+
+with open(os.path.join(root, "settings.json.example"), encoding="utf-8") as f:
+    settings = json.load(f)
+settings["database"] = os.path.join(workdir, "travelynx-relay.sqlite3")
+with open(os.path.join(workdir, "settings.json"), "w", encoding="utf-8") as f:
+    json.dump(settings, f)
+shutil.copy(os.path.join(root, "train_types.toml"), workdir)
+
+# "" on sys.path would mean the scratch directory once we're in there
+sys.path.insert(0, root)
+cwd = os.getcwd()
+os.chdir(workdir)
+try:
+    # pylint: disable=wrong-import-position,unused-import
+    from travelhook import database as DB
+    from travelhook import format as F
+finally:
+    os.chdir(cwd)
+
+
+def migrate(path):
+    "set up a database like the readme says, by running all migrations on it in order"
+    connection = sqlite3.connect(path)
+    for migration in sorted(glob.glob(os.path.join(root, "migrations", "*.sql"))):
+        with open(migration, encoding="utf-8") as f:
+            connection.executescript(f.read())
+    connection.close()
+
+
+def connect(path):
+    "a fresh database at path, migrated and connected as travelhook's database"
+    migrate(path)
+    DB.connect(path)
+    return DB
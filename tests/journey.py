@@ -0,0 +1,164 @@
+"""a made-up journey with a bit of everything the journey embed draws: changes at the same
+station and with a walk, a trip hafas didn't find, and at the end a comment, a composition
+and hafas and dbris messages, some of them repeated or announcing something. only data, so
+whichever version of travelhook is around can load it"""
+
+USER = {
+    "discord_id": 42,
+    "token_status": "s",
+    "token_webhook": "w42",
+    "token_travel": None,
+    "break_journey": 0,
+    "suggestions": "",
+    "show_train_numbers": True,
+    "timezone": "Europe/Berlin",
+}
+# 2024-05-17 12:00 in berlin, an ordinary friday
+T = 1715940000
+
+STATIONS = {
+    "ka": ("Karlsruhe Hbf", 8000191, 48.993512, 8.401848),
+    "hd": ("Heidelberg Hbf", 8000156, 49.403582, 8.675442),
+    "ma": ("Mannheim Hbf", 8000244, 49.479352, 8.469042),
+    "kunsthalle": ("Mannheim, Kunsthalle", 8070914, 49.483590, 8.474690),
+    "parade": ("Mannheim, Paradeplatz", 8070870, 49.487300, 8.466300),
+    "f": ("Frankfurt(Main)Hbf", 8000105, 50.106817, 8.663003),
+}
+
+
+def station(key, scheduled, delay):
+    name, uic, lat, lon = STATIONS[key]
+    return {
+        "name": name,
+        "uic": uic,
+        "latitude": lat,
+        "longitude": lon,
+        "scheduledTime": scheduled,
+        "realTime": scheduled + delay,
+    }
+
+
+def status(train, backend, start, end, comment="", **extra):
+    return {
+        "checkedIn": True,
+        "comment": comment,
+        "visibility": {"desc": "public", "level": 100},
+        "backend": backend,
+        "train": train,
+        "fromStation": station(*start),
+        "toStation": station(*end),
+        "intermediateStops": [],
+        **extra,
+    }
+
+
+def polyline(start, end, points=20):
+    "a straight line between the two stations"
+    name0, eva0, lat0, lon0 = STATIONS[start]
+    name1, eva1, lat1, lon1 = STATIONS[end]
+    line = [
+        {
+            "lat": lat0 + (lat1 - lat0) * n / points,
+            "lon": lon0 + (lon1 - lon0) * n / points,
+            "eva": None,
+            "name": None,
+        }
+        for n in range(points + 1)
+    ]
+    line[0] |= {"eva": eva0, "name": name0}
+    line[-1] |= {"eva": eva1, "name": name1}
+    return line
+
+
+def route(*keys):
+    return [
+        {"name": STATIONS[key][0], "eva": STATIONS[key][1], "sched_arr": None}
+        for key in keys
+    ]
+
+
+DB_HAFAS = {"type": "HAFAS", "name": "DB", "id": 1}
+
+# (travelynx status, hafas data) for each trip of the journey in order
+TRIPS = [
+    (
+        status(
+            {"type": "S", "line": "3", "no": "38339", "id": "1|201532|0|80|17052024"},
+            DB_HAFAS,
+            ("ka", T, 120),
+            ("hd", T + 2880, 60),
+            operator="DB Regio AG",
+        ),
+        {
+            "id": "1|201532|0|80|17052024",
+            "headsign": "Bensheim",
+            "beeline": False,
+            "route": route("ka", "hd"),
+            "polyline": polyline("ka", "hd"),
+        },
+    ),
+    (
+        status(
+            {"type": "RE", "line": "10a", "no": "4721", "id": "1|98765|0|80|17052024"},
+            DB_HAFAS,
+            ("hd", T + 3300, 0),
+            ("ma", T + 4500, 240),
+        ),
+        {
+            "id": "1|98765|0|80|17052024",
+            "headsign": "Mannheim Hbf",
+            "beeline": False,
+            "route": route("hd", "ma"),
+            "polyline": polyline("hd", "ma"),
+        },
+    ),
+    (
+        status(
+            {"type": "STR", "line": "5", "no": "0", "id": "1|5555|0|81|17052024"},
+            DB_HAFAS,
+            ("kunsthalle", T + 5400, 0),
+            ("parade", T + 5700, 0),
+            operator="Rhein-Neckar-Verkehr GmbH",
+        ),
+        {"failedhafas": True},
+    ),
+    (
+        status(
+            {"type": "ICE", "line": None, "no": "73", "id": "1|73|0|80|17052024"},
+            DB_HAFAS,
+            ("ma", T + 7200, 300),
+            ("f", T + 9600, 420),
+            comment="Platz im Bordrestaurant gefunden",
+            composition="ICE 4 (Tz 9018)",
+            operator="DB Fernverkehr AG",
+        ),
+        {
+            "id": "1|73|0|80|17052024",
+            "headsign": "Hamburg-Altona",
+            "beeline": False,
+            "route": route("ma", "f"),
+            "polyline": polyline("ma", "f"),
+            "messages": [
+                {"type": "D", "code": "", "text": "Verspätung aus vorheriger Fahrt"},
+                {"type": "D", "code": "", "text": "Verspätung aus vorheriger Fahrt"},
+                {"type": "Q", "code": "", "text": "Vorankündigung! Bauarbeiten im Juni"},
+                {
+                    "type": "Q",
+                    "code": "",
+                    "text": "Mannheim Hbf - Frankfurt(Main)Hbf: Information. Bordrestaurant nur mit Kartenzahlung",
+                },
+                {
+                    "type": "L",
+                    "code": "",
+                    "text": "Basel SBB - Hamburg-Altona: Information. Umleitung über Darmstadt",
+                },
+                {"type": "X", "code": "ZN", "text": "Zusätzlicher Halt in Weinheim"},
+                {"prioritaet": "NIEDRIG", "text": "WLAN nicht verfügbar"},
+                {"prioritaet": "HOCH", "text": "Wagen 9 fehlt"},
+            ],
+            "stop_messages": {
+                "8000244": [{"type": "D", "code": "", "text": "Gleiswechsel"}]
+            },
+        },
+    ),
+]
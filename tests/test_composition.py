@@ -0,0 +1,109 @@
+"Trip.fetch_composition with stand-in providers"
+import asyncio
+import json
+
+import pytest
+
+from .environment import DB
+
+Result = DB.CompositionResult
+
+
+def providers(trip, **results):
+    """replace the trip's composition providers. each of results is a provider name without
+    get_ and _composition, and (seconds, result) for what it returns after how long, or an
+    exception to raise then. a callable result gets called then and returns the result.
+    the others don't find anything"""
+    for name in ("oebb", "db", "ns", "vagonweb", "rtt"):
+        delay, result = results.get(name, (0, None))
+
+        async def provider(delay=delay, result=result):
+            await asyncio.sleep(delay)
+            if isinstance(result, BaseException):
+                raise result
+            if callable(result):
+                return result()
+            return result
+
+        provider.__name__ = f"get_{name}_composition"
+        setattr(trip, provider.__name__, provider)
+
+
+def test_provider_timeout_doesnt_end_search(db, trips):
+    "one provider running into its own timeout doesn't throw away what another finds"
+    trip = trips[0]
+    providers(
+        trip,
+        oebb=(0, asyncio.TimeoutError()),
+        db=(0.2, Result({"composition": "2x 423"})),
+        ns=(0, Result({"failedcomposition-ns": True})),
+    )
+    asyncio.run(trip.fetch_composition())
+    status = db.Trip.find(trip.user_id, trip.journey_id).status
+    assert status["composition"] == "2x 423"
+    assert status["failedcomposition-ns"]
+
+
+def test_deadline(db, trips, monkeypatch):
+    "composition_timeout ends the search, with whatever we found out until then"
+    monkeypatch.setitem(db.config, "composition_timeout", 0.2)
+    trip = trips[0]
+    providers(
+        trip,
+        db=(5, Result({"composition": "2x 423"})),
+        ns=(0, Result({"failedcomposition-ns": True})),
+    )
+    asyncio.run(trip.fetch_composition())
+    status = db.Trip.find(trip.user_id, trip.journey_id).status
+    assert "composition" not in status
+    assert status["failedcomposition-ns"]
+
+
+def test_keeps_newer_hafas_data(db, trips):
+    """the train name goes into the hafas data as it is by the time the composition gets
+    written, not as it was when the providers started. the composition links to its page"""
+    trip = trips[0]
+    url = "https://www.vagonweb.cz/razeni/vlak.php?zeme=CD&cislo=38339"
+
+    def meanwhile():
+        "a hafas retry storing new hafas data while the provider waits for vagonweb"
+        db.DB.execute(
+            "UPDATE trips SET hafas_data = ? WHERE user_id = ? AND journey_id = ?",
+            (
+                json.dumps({"id": "newer", "messages": [{"text": "hi"}]}),
+                trip.user_id,
+                trip.journey_id,
+            ),
+        )
+        return Result({"composition": "2x 423"}, link=url, train_name="Zugname")
+
+    providers(trip, vagonweb=(0, meanwhile))
+    asyncio.run(trip.fetch_composition())
+    stored = db.Trip.find(trip.user_id, trip.journey_id)
+    assert stored.hafas_data["id"] == "newer"
+    assert [m["text"] for m in stored.hafas_data["messages"]] == ["hi", "Zugname"]
+    short_id = db.Link.find_by_long(url).short_id
+    assert stored.status["composition"] == (
+        f"[2x 423]({db.config['shortener_url']}/{short_id})"
+    )
+
+
+def test_one_transaction(db, trips, monkeypatch):
+    "the short link, the train name and the patch get written together or not at all"
+    trip = trips[0]
+    url = "https://www.vagonweb.cz/razeni/vlak.php?zeme=CD&cislo=38339"
+
+    def broken_write_patch(_status_patch):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(trip, "write_patch", broken_write_patch)
+    providers(
+        trip,
+        vagonweb=(0, Result({"composition": "2x 423"}, link=url, train_name="Zugname")),
+    )
+    with pytest.raises(RuntimeError):
+        asyncio.run(trip.fetch_composition())
+    stored = db.Trip.find(trip.user_id, trip.journey_id)
+    assert db.Link.find_by_long(url) is None
+    assert "messages" not in stored.hafas_data
+    assert "composition" not in stored.status
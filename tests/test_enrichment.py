@@ -0,0 +1,23 @@
+"background work started from a webhook or an interaction"
+import asyncio
+
+from .environment import DB
+from travelhook import enrichment  # pylint: disable=wrong-import-order
+
+
+def test_retries_dont_keep_the_unit_of_work(db, trips, monkeypatch):
+    "a retry can run hours after the interaction that scheduled it has been reported"
+    units = []
+
+    async def retry(_user_id, _journey_id):
+        units.append(DB.current_unit.get())
+
+    async def run():
+        scheduler = enrichment.RetryScheduler(on_success=None)
+        monkeypatch.setattr(scheduler, "retry", retry)
+        with DB.unit_of_work("interaction"):
+            scheduler.schedule(trips[0])
+        await asyncio.gather(*scheduler.pending.values())
+
+    asyncio.run(run())
+    assert units == [None]
@@ -0,0 +1,42 @@
+"merge_patch should do exactly what sqlite's json_patch() did for us before"
+import copy
+import json
+import random
+import sqlite3
+
+from .environment import DB
+
+KEYS = ["train", "type", "line", "no", "composition", "comment", "a", "b"]
+
+
+def random_value(rng, depth):
+    kind = rng.random()
+    if depth < 3 and kind < 0.35:
+        return {
+            rng.choice(KEYS): random_value(rng, depth + 1)
+            for _ in range(rng.randint(0, 4))
+        }
+    if kind < 0.45:
+        return None
+    if kind < 0.55:
+        return [random_value(rng, 3) for _ in range(rng.randint(0, 3))]
+    return rng.choice([0, 1, -7, 2.5, True, False, "", "ICE", "S 3", "ü"])
+
+
+def random_object(rng):
+    return {rng.choice(KEYS): random_value(rng, 1) for _ in range(rng.randint(0, 5))}
+
+
+def test_same_as_sqlite():
+    rng = random.Random(7386)
+    connection = sqlite3.connect(":memory:")
+    for _ in range(20000):
+        target = random_object(rng)
+        patch = random_object(rng)
+        (expected,) = connection.execute(
+            "SELECT json_patch(?, ?)", (json.dumps(target), json.dumps(patch))
+        ).fetchone()
+        original = copy.deepcopy(target)
+        assert DB.merge_patch(target, patch) == json.loads(expected), (target, patch)
+        assert target == original, "changed the target without in_place"
+        assert DB.merge_patch(target, patch, in_place=True) == json.loads(expected)
@@ -0,0 +1,189 @@
+"""get_network should find the same network as the chain of checks it used to be, before the
+regions moved into train_types.toml. the cases are made up from a table of places, train
+types, operators and station ids around every region, including just outside of them."""
+import math
+import random
+
+from haversine import haversine
+
+from .environment import F
+
+TYPES = ["", "STR", "TRAM", "RNV", "STB", "str ", "Stb", "U", "M", "S", "Bus", "ICE"]
+# mostly outside of austria, that one would win over most of the regions otherwise
+UICS = [None, None, 8000105, 8000244, 8400058, 7000500, 8100001, 8199999, 8200000]
+LINES = ["", "1", "S3", "DLR", *sorted(F.london_underground_lines)[:3]]
+OPERATORS = [
+    "",
+    "",
+    "",
+    "DB Regio AG",
+    "Rhein-Neckar-Verkehr GmbH",
+    "RNV",
+    "Wiener Linien GmbH & Co KG",
+    "Regiobahn GmbH",
+    "Bayerische Regiobahn",
+    "London Overground",
+    "London Underground (TfL)",
+    *(
+        operator
+        for rule in F.train_types_config["networks"]
+        for operator in rule.get("operator", ())
+    ),
+]
+
+
+def chain_network(status, operator):
+    "the network like get_network found it before train_types.toml had the networks"
+    lat = status["fromStation"]["latitude"]
+    lon = status["fromStation"]["longitude"]
+
+    if operator == "Nederlandse Spoorwegen":
+        return "NS"
+    if operator in (
+        "Albtal-Verkehrs-Gesellschaft mbH",
+        "Albtal-Verkehrs-Gesellschaft",
+        "Tram VBK",
+        "Verkehrsbetriebe Karlsruhe GmbH",
+    ) or (
+        status["train"]["type"] in ("STR", "TRAM")
+        and haversine((lat, lon), (49.009, 8.417)) < 15
+    ):
+        return "KVV"
+    if (
+        operator.startswith("Rhein-Neckar-Verkehr")
+        or operator.startswith("RNV")
+        or (
+            (status["train"]["type"] in ("", "STR", "RNV", "TRAM"))
+            and haversine((lat, lon), (49.47884, 8.55787)) < 29
+        )
+    ):
+        return "RNV"
+    if operator.startswith("Wiener Linien"):
+        return "WL"
+    if "regiobahn" in operator.casefold():
+        return "REGIOBAHN"
+    if haversine((lat, lon), (48.21, 16.39)) < 70:
+        return "SWien"
+    if (
+        8100000 < (status["fromStation"]["uic"] or 0) < 8200000
+        or 8100000 < (status["toStation"]["uic"] or 0) < 8200000
+    ):
+        return "AT"
+    if haversine((lat, lon), (50.08, 14.42)) < 12:
+        return "DPP"
+    if haversine((lat, lon), (47.49, 19.04)) < 10:
+        return "BKV"
+    if (
+        status["train"]["type"].casefold().strip() in ("str", "stb")
+        and haversine((lat, lon), (52.369, 9.740)) < 20
+    ):
+        return "Ü"
+    if (50.62 < lat < 51.04) and (6.72 < lon < 7.26):
+        return "KVB"
+    if haversine((lat, lon), (52.52, 13.41)) < 30:
+        return "BVG"
+    if haversine((lat, lon), (53.54, 10.01)) < 30:
+        return "HHA"
+    if haversine((lat, lon), (48.15, 11.54)) < 30:
+        return "MVG"
+    if (51.06 < lat < 51.68) and (6.46 < lon < 7.77):
+        return "NRW"
+    if haversine((lat, lon), (49.45, 11.05)) < 10:
+        return "VAG"
+    if haversine((lat, lon), (50.11, 8.68)) < 30:
+        return "VGF"
+    if haversine((lat, lon), (49.25, 6.98)) < 19 and status["train"]["type"] in (
+        "STR",
+        "STB",
+    ):
+        return "SAAR"
+    if operator in ("Blauwnet", "Arriva Nederland", "RRReis", "R-net"):
+        return "ST"
+    if operator in (
+        "Schweizerische Bundesbahnen",
+        "Schweizerische Bundesbahnen SBB",
+        "Schweizerische Südostbahn (sob)",
+        "BLS AG",
+        "BLS AG (bls)",
+    ):
+        return "CH-FV"
+    if operator in (
+        "Transport publics de la Région Lausannoise",
+        "Transports Publics de la Région Lausannoise sa",
+    ) or (
+        haversine((lat, lon), (46.52, 6.63)) < 6
+        and status["train"]["type"] in ("U", "M")
+    ):
+        return "tl"
+    if operator == "CTS":
+        return "CTS"
+
+    trainplusline = (
+        f"{status['train']['type']} {status['train']['line']}".removeprefix("SUBWAY")
+        .removeprefix("METRO")
+        .strip()
+    )
+    if (
+        (7000000 < (status["fromStation"]["uic"] or 0) < 7100000)
+        or trainplusline in F.london_overground_lines
+        or trainplusline in F.london_underground_lines
+        or trainplusline in F.british_tocs
+        or trainplusline in ("STR DLR", "DLR")
+        or operator
+        in (
+            "London Overground",
+            "London Docklands Light Railway - TfL",
+            "London Underground (TfL)",
+        )
+    ):
+        return "UK"
+    return ""
+
+
+def place(rng):
+    "somewhere in or around a region, close to its edge, or anywhere in central europe"
+    rules = F.train_types_config["networks"]
+    rule = rng.choice([rule for rule in rules if "circle" in rule or "box" in rule])
+    kind = rng.random()
+    if kind < 0.5 and "circle" in rule:
+        lat, lon, km = rule["circle"]
+        # up to a bit past the edge, and a good number right around it
+        if rng.random() < 0.3:
+            distance = km * rng.uniform(0.97, 1.03)
+        else:
+            distance = km * rng.uniform(0, 1.3)
+        angle = rng.uniform(0, 2 * math.pi)
+        return (
+            lat + distance / 111.2 * math.sin(angle),
+            lon + distance / (111.2 * math.cos(math.radians(lat))) * math.cos(angle),
+        )
+    if kind < 0.5:
+        lat_min, lat_max, lon_min, lon_max = rule["box"]
+        return (
+            rng.uniform(lat_min - 0.05, lat_max + 0.05),
+            rng.uniform(lon_min - 0.05, lon_max + 0.05),
+        )
+    return rng.uniform(45, 55), rng.uniform(3, 20)
+
+
+def cases(count, seed=22):
+    rng = random.Random(seed)
+    for _ in range(count):
+        lat, lon = place(rng)
+        operator = rng.choice(OPERATORS)
+        status = {
+            "train": {"type": rng.choice(TYPES), "line": rng.choice(LINES)},
+            "fromStation": {"latitude": lat, "longitude": lon, "uic": rng.choice(UICS)},
+            "toStation": {"uic": rng.choice(UICS)},
+            "operator": operator,
+        }
+        yield status, operator
+
+
+def test_same_as_chain():
+    mismatches = []
+    for status, operator in cases(50000):
+        expected = chain_network(status, operator)
+        if (network := F.get_network(status, {})) != expected:
+            mismatches.append((status, expected, network))
+    assert not mismatches, mismatches[:10]
@@ -0,0 +1,98 @@
+"PerlWorkerPool against a stand-in worker, which answers according to the script asked for"
+import asyncio
+import os
+import stat
+import sys
+
+from .environment import DB
+
+WORKER = f"""#!{sys.executable}
+import json, sys, time
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["script"] == "sleep":
+        time.sleep(60)
+    elif request["script"] == "big":
+        sys.stdout.write("x" * (2**24 + 10) + "\\n")
+    elif request["script"] == "die":
+        sys.exit(1)
+    else:
+        sys.stdout.write(json.dumps(request["args"]) + "\\n")
+    sys.stdout.flush()
+"""
+
+
+def pool_with_worker(tmp_path, monkeypatch):
+    "a pool of one, running the stand-in and remembering every worker it started"
+    path = tmp_path / "json-hafas-worker.pl"
+    path.write_text(WORKER)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    pool = DB.PerlWorkerPool(1, 1)
+    spawned = []
+    spawn = pool.spawn
+
+    async def spawn_and_remember():
+        spawned.append(await spawn())
+        return spawned[-1]
+
+    pool.spawn = spawn_and_remember
+    return pool, spawned
+
+
+async def shut_down(pool):
+    for worker in pool.idle:
+        worker.kill()
+        await worker.wait()
+
+
+def test_reuses_worker(tmp_path, monkeypatch):
+    pool, spawned = pool_with_worker(tmp_path, monkeypatch)
+
+    async def run():
+        replies = [await pool.request("echo", "a", i) for i in range(3)]
+        await shut_down(pool)
+        return replies
+
+    assert asyncio.run(run()) == [f'["a", "{i}"]\n'.encode() for i in range(3)]
+    assert len(spawned) == 1
+
+
+def test_timeout(tmp_path, monkeypatch):
+    "a timeout is None rather than empty output, and the killed worker doesn't stay a zombie"
+    pool, spawned = pool_with_worker(tmp_path, monkeypatch)
+
+    async def run():
+        reply = await pool.request("sleep", timeout=0.2)
+        return reply, await pool.request("echo", "b")
+
+    assert asyncio.run(run()) == (None, b'["b"]\n')
+    assert spawned[0].returncode is not None
+    assert len(spawned) == 2
+
+
+def test_cancelled(tmp_path, monkeypatch):
+    pool, spawned = pool_with_worker(tmp_path, monkeypatch)
+
+    async def run():
+        request = asyncio.ensure_future(pool.request("sleep"))
+        await asyncio.sleep(0.2)
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+
+    asyncio.run(run())
+    assert spawned[0].returncode is not None
+
+
+def test_dead_worker_retried_once(tmp_path, monkeypatch):
+    pool, spawned = pool_with_worker(tmp_path, monkeypatch)
+    assert asyncio.run(pool.request("die")) == b""
+    assert len(spawned) == 2
+    assert all(worker.returncode is not None for worker in spawned)
+
+
+def test_overlong_reply_not_retried(tmp_path, monkeypatch):
+    pool, spawned = pool_with_worker(tmp_path, monkeypatch)
+    assert asyncio.run(pool.request("big")) == b""
+    assert len(spawned) == 1
+    assert spawned[0].returncode is not None
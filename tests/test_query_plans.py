@@ -0,0 +1,75 @@
+"the statements travelhook runs should find their rows through an index, not by reading whole tables"
+import ast
+import os
+import re
+import sqlite3
+
+import pytest
+
+from .environment import root
+
+MODULES = ("database.py", "helpers.py", "format.py", "oebb_wr.py")
+# these really do want every row, once on startup or for the command syncing
+FULL_LOADS = {
+    "SELECT * FROM oebb_stopfinder",
+    "SELECT name FROM cities",
+    "SELECT * FROM cts_stops",
+    "SELECT * FROM servers",
+}
+
+
+def sql_text(node):
+    "the statement node stands for, with ? for everything formatted into it"
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        # only ever used for lists of placeholders like IN (?,?,?)
+        return "".join(
+            value.value if isinstance(value, ast.Constant) else "?"
+            for value in node.values
+        )
+    return None
+
+
+def statements():
+    "every statement passed to DB.execute, directly or as write(DB.execute, statement, ...)"
+    for module in MODULES:
+        with open(os.path.join(root, "travelhook", module), encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not node.args:
+                continue
+            if isinstance(node.func, ast.Attribute) and node.func.attr == "execute":
+                sql = sql_text(node.args[0])
+            elif (
+                isinstance(node.args[0], ast.Attribute)
+                and node.args[0].attr == "execute"
+                and len(node.args) > 1
+            ):
+                sql = sql_text(node.args[1])
+            else:
+                continue
+            # leaves out PRAGMAs and BEGIN/COMMIT/ROLLBACK
+            if sql and sql.split()[0] in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+                yield pytest.param(sql, id=f"{module}:{node.lineno}")
+
+
+STATEMENTS = list(statements())
+
+
+def test_found_statements():
+    assert len(STATEMENTS) > 40
+
+
+@pytest.mark.parametrize("sql", STATEMENTS)
+def test_no_table_scans(migrated_database, sql):
+    if sql in FULL_LOADS:
+        pytest.skip("loads the whole table on purpose")
+    connection = sqlite3.connect(migrated_database)
+    plan = connection.execute(
+        f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")
+    ).fetchall()
+    connection.close()
+    # "SCAN trips" reads the whole table, "SCAN trips USING INDEX ..." only an index
+    scans = [detail for *_, detail in plan if re.fullmatch(r"SCAN \w+", detail)]
+    assert not scans, f"{sql}\n{plan}"
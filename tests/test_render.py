@@ -0,0 +1,111 @@
+"rendering journey embeds"
+import asyncio
+import contextlib
+import json
+import os
+import re
+
+from .environment import F
+
+
+@contextlib.contextmanager
+def count_queries(db):
+    "count the statements this thread runs on the database in the block"
+    statements = []
+    connection = db.DB.connection()
+    connection.set_trace_callback(statements.append)
+    try:
+        yield statements
+    finally:
+        connection.set_trace_callback(None)
+
+
+def test_render_journey_doesnt_query(db, bot, trips):
+    "build_render_context loads everything at once, render_journey only reads the context"
+    # trips rendered before would come from the fragment cache without being rendered
+    F.fragment_cache.invalidate(*F.fragment_cache.entries)
+    for continue_link in (None, "[continue](https://example.org)"):
+        for end in range(1, len(trips) + 1):
+            ctx = F.build_render_context(bot, 42, trips[:end], continue_link)
+            with count_queries(db) as statements:
+                F.render_journey(ctx)
+            assert statements == []
+
+
+def test_render_context_queries(db, bot, trips):
+    "the user, the polylines and the links, however many trips there are"
+    F.build_render_context(bot, 42, trips)
+    with count_queries(db) as statements:
+        F.build_render_context(bot, 42, trips)
+    # the user comes from the user cache
+    assert len(statements) <= 2, statements
+
+
+def normalized(db, embed):
+    "the embed as a dict, without the time we rendered it and with the long urls of short links"
+    embed = embed.to_dict()
+    embed.pop("timestamp", None)
+    return json.loads(
+        re.sub(
+            re.escape(F.config["shortener_url"]) + r"/(\w+)",
+            lambda m: db.Link.find_by_short(m[1]).long_url,
+            json.dumps(embed, ensure_ascii=False),
+        )
+    )
+
+
+def test_same_as_before(db, bot, trips):
+    """embeds for the sample journey and every part of it should stay what the renderer made
+    of them before it was split up and cached, at 6374f08. rendering twice, the second time
+    from the fragment cache, has to give the same embed as well"""
+    path = os.path.join(os.path.dirname(__file__), "journey_embeds.json")
+    with open(path, encoding="utf-8") as f:
+        expected = json.load(f)
+    for case in expected:
+        for again in (False, True):
+            hits = F.fragment_cache.hits
+            embed = F.format_travelynx(
+                bot, 42, trips[: case["trips"]], case["continue_link"]
+            )
+            assert normalized(db, embed) == case["embed"], (
+                case["trips"],
+                case["continue_link"],
+            )
+            if again:
+                assert F.fragment_cache.hits - hits == case["trips"]
+
+
+def test_render_cache_follows_refresh(db, bot, trips):
+    "a trip that got refreshed in place within the unit of work gets rendered again"
+    with db.unit_of_work("webhook"):
+        before = F.format_travelynx(bot, 42, trips)
+        status = dict(trips[-1].status, comment="Doch kein Platz")
+        db.Trip.upsert(42, status)
+        trips[-1].refresh()
+        after = F.format_travelynx(bot, 42, trips)
+    assert "Doch kein Platz" not in before.description
+    assert "Doch kein Platz" in after.description
+
+
+def test_links_made_once_per_unit(db, bot, trips, monkeypatch):
+    "posting to several channels makes the short links in the writer thread only once"
+    writes = []
+    write = db.write
+
+    async def counting_write(fn, *args, **kwargs):
+        writes.append(fn)
+        return await write(fn, *args, **kwargs)
+
+    monkeypatch.setattr(db, "write", counting_write)
+
+    async def webhook():
+        with db.unit_of_work("webhook"):
+            for continue_link in (None, None, "[continue](https://example.org)"):
+                await F.aformat_travelynx(bot, 42, trips, continue_link)
+            assert writes == [F.make_journey_links]
+            # the previous message has map and copy links of its own
+            await F.aformat_travelynx(bot, 42, trips[:-1], "[next](https://example.org)")
+            await F.aformat_travelynx(bot, 42, trips[:-1], "[next](https://example.org)")
+            assert writes == [F.make_journey_links] * 2
+
+    asyncio.run(webhook())
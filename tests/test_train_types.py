@@ -0,0 +1,58 @@
+"""train_type_index should pick the same train_types entry as going through the list in order
+and taking the first that matches, which is what get_display used to do"""
+from .environment import F
+
+TRAIN_TYPES = F.train_types_config["train_types"]
+
+
+def linear_match(type, line, network):
+    "the first entry that matches, the way get_display looked for it before the index"
+    for tt in TRAIN_TYPES:
+        if (
+            (not "type" in tt or tt["type"].casefold() == type.casefold())
+            and (not "line" in tt or tt["line"] == line)
+            and (
+                not "line_startswith" in tt
+                or (line and line.startswith(tt["line_startswith"]))
+            )
+            and (not "network" in tt or tt["network"].casefold() == network.casefold())
+        ):
+            return tt
+    return None
+
+
+def variants(line):
+    "line itself and lines around it that some prefix could match or just miss"
+    return {line, line + "1", line + "X", line[:-1]}
+
+
+def cases():
+    """every type in every casing, with every line an entry for that type or for any type
+    cares about, in every network. lines no entry mentions all behave the same, so a few
+    of those stand in for the rest"""
+    types = {tt["type"] for tt in TRAIN_TYPES if "type" in tt} | {"", "NOSUCHTYPE"}
+    networks = {tt["network"] for tt in TRAIN_TYPES if "network" in tt}
+    networks |= {network.upper() for network in networks} | {"", "NOSUCHNETWORK"}
+    for type in types:
+        lines = {None, "", "1", "42", "NOSUCHLINE"}
+        for tt in TRAIN_TYPES:
+            if not "type" in tt or tt["type"].casefold() == type.casefold():
+                for key in ("line", "line_startswith"):
+                    if key in tt:
+                        lines |= variants(tt[key])
+        for casing in {type, type.upper(), type.lower()}:
+            for line in lines:
+                for network in networks:
+                    yield casing, line, network
+
+
+def test_same_as_linear_match():
+    mismatches = []
+    checked = 0
+    for type, line, network in cases():
+        checked += 1
+        expected = linear_match(type, line, network)
+        if F.train_type_index.match(type, line, network) is not expected:
+            mismatches.append((type, line, network, expected))
+    assert checked > 10000
+    assert not mismatches, mismatches[:20]
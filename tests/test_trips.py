@@ -0,0 +1,35 @@
+"storing trips and what we find out about them"
+import copy
+
+from .journey import TRIPS
+
+
+def stored_network(db, trip):
+    (network,) = db.DB.execute(
+        "SELECT network FROM trips WHERE user_id = ? AND journey_id = ?",
+        (trip.user_id, trip.journey_id),
+    ).fetchone()
+    return network
+
+
+def test_network_stored_after_fixing_1970(db, trips):
+    """fixing the arrival time stores the status again, which resets the stored network.
+    it has to be stored again even if it's still the same network"""
+    status, hafas_data = copy.deepcopy(TRIPS[0])
+    arrival = status["toStation"]["scheduledTime"]
+    status["toStation"]["scheduledTime"] = status["toStation"]["realTime"] = 0
+    db.Trip.upsert(trips[0].user_id, status)
+    trip = db.Trip.find(trips[0].user_id, trips[0].journey_id)
+    # hafas doesn't know the arrival either yet, so there's nothing to fix
+    hafas_data["route"][-1] |= {"sched_arr": None, "sched_dep": None, "rt_arr": None}
+    with db.DB.transaction():
+        trip.save_hafas_data(copy.deepcopy(hafas_data))
+    assert stored_network(db, trip) is not None
+
+    hafas_data["route"][-1]["sched_arr"] = arrival
+    with db.DB.transaction():
+        trip.save_hafas_data(hafas_data)
+
+    trip = db.Trip.find(trip.user_id, trip.journey_id)
+    assert trip.status["toStation"]["realTime"] == arrival
+    assert stored_network(db, trip) is not None
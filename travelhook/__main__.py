@@ -14,7 +14,7 @@ from copy import deepcopy
 from datetime import datetime, timedelta, timezone as dt_tz
 from zoneinfo import ZoneInfo
 
-from aiohttp import ClientSession, web
+from aiohttp import ClientTimeout, web
 import discord
 from discord.ext import commands
 from haversine import haversine
@@ -22,24 +22,28 @@ import tomli
 import tomli_w
 
 from . import database as DB
+from . import enrichment
 from . import oebb_wr
 from .format import (
+    aformat_travelynx,
     blanket_replace_train_type,
     emoji,
-    format_travelynx,
     get_display,
     train_types_config,
     get_network,
 )
 from .helpers import (
     available_tzs,
+    close_session,
     format_composition_element,
     format_time,
     generate_train_link,
+    get_session,
     is_token_valid,
     is_import_token_valid,
     LineEmoji,
     not_registered_embed,
+    train_link_url,
     train_type_color,
     trip_length,
     zugid,
@@ -61,13 +65,41 @@ bot = commands.Bot(command_prefix=" ", intents=intents)
 
 
 async def setup_hook():
-    "enable restart persistence for the register button by adding the view on start"
+    """enable restart persistence for the register button by adding the view on start,
+    open our http session, start the enrichment workers and pick up retrying hafas data
+    for the trips where that failed before we restarted"""
     bot.add_view(RegisterTravelynxStepZero())
+    get_session()
+    enrichment_queue.start()
+    # older trips had their chance, don't let them eat the retry budget of new ones
+    since = datetime.now() - timedelta(seconds=config.get("hafas_retry_max_age", 86400))
+    for trip in DB.Trip.find_failed_hafas(since.timestamp()):
+        hafas_retries.schedule(trip)
 
 
 bot.setup_hook = setup_hook
 
 
+async def close():
+    "shut down the bot, then everything we started alongside it"
+    await commands.Bot.close(bot)
+    await close_session()
+
+
+bot.close = close
+
+
+async def interaction_check(ia):
+    """give every command its own unit of work. discord.py runs each one in a task of its
+    own, so it ends and gets reported with the command without us having to put a block
+    around it"""
+    DB.begin_unit_of_work(f"interaction {ia.command.name if ia.command else ia.type}")
+    return True
+
+
+bot.tree.interaction_check = interaction_check
+
+
 @bot.event
 async def on_ready():
     "once we're logged in, set up commands and start the web server"
@@ -78,6 +110,12 @@ async def on_ready():
 
 
 async def handle_status_update(userid, reason, status):
+    "store a status update and wait until we've found out everything else about the trip"
+    trip = await DB.write_transaction(store_status_update, userid, reason, status)
+    await enrich_trip(trip)
+
+
+def store_status_update(userid, reason, status):
     """update trip data in the database, also starting a new journey if the last data
     we have is too old or distant for this to be a changeover"""
 
@@ -128,15 +166,77 @@ async def handle_status_update(userid, reason, status):
         user.do_break_journey()
 
     DB.Trip.upsert(userid, status)
-    trip = DB.Trip.find(userid, zugid(status))
-    trip.fetch_headsign()  # also runs fetch_hafas_data in the background
-    trip.maybe_fix_1970()
-    trip.maybe_patch_sev()
-    await trip.get_oebb_composition()
-    trip.get_db_composition()
-    await trip.get_ns_composition()
-    await trip.get_vagonweb_composition()
-    await trip.get_rtt_composition()
+    return DB.Trip.find(userid, zugid(status))
+
+
+async def enrich_trip(trip):
+    "fetch hafas data and the composition for a trip we just stored"
+    await trip.fetch_hafas_data()
+    if "failedhafas" in trip.hafas_data:
+        hafas_retries.schedule(trip)
+    # new hafas data already got applied along with storing it, but if we had some
+    # already, the status we just got from travelynx might need the same fixes again.
+    # we're not holding the user's lock, but apply_hafas_data loads the trip again first,
+    # so a newer status from a webhook that came in meanwhile doesn't get overwritten
+    await DB.write_transaction(trip.apply_hafas_data)
+    await trip.fetch_composition()
+
+
+async def enrich_in_background(userid, journey_id):
+    "enrich a trip the webhook stored and update the live feed if we found out anything new"
+    if not (trip := await DB.Trip.afind(userid, journey_id)):
+        return
+    before = json.dumps([trip.hafas_data, trip.status_patch])
+    await enrich_trip(trip)
+    if json.dumps([trip.hafas_data, trip.status_patch]) != before:
+        await rerender_trip(trip)
+
+
+async def rerender_trip(trip):
+    """edit the live feed messages for trip, for when we found out something new
+    about it in the background instead of from a webhook"""
+    with DB.unit_of_work(f"rerender {trip.journey_id}"):
+        user = DB.User.find(discord_id=trip.user_id)
+        async with user.get_lock():
+            current_trips = await DB.Trip.afind_current_trips_for(trip.user_id)
+            if not trip.journey_id in [t.journey_id for t in current_trips]:
+                return
+
+            for message in DB.Message.find_all(trip.user_id, trip.journey_id):
+                trips = current_trips
+                continue_link = None
+                if newer_message := DB.Message.find_newer_than(
+                    trip.user_id, message.channel_id, message.message_id
+                ):
+                    continue_link = (await newer_message.fetch(bot)).jump_url
+                    current_trip_index = [t.journey_id for t in trips].index(
+                        trip.journey_id
+                    )
+                    trips = trips[0 : current_trip_index + 1]
+
+                embed = await aformat_travelynx(
+                    bot,
+                    trip.user_id,
+                    trips,
+                    continue_link=continue_link,
+                )
+                if len(embed) > 4096 and not continue_link:
+                    # too long with what we found out! break the journey like the webhook
+                    # would have, so this trip starts the next one.
+                    await DB.write(user.do_break_journey, keep=trip.journey_id)
+                    current_trips = trips = await DB.Trip.afind_current_trips_for(
+                        trip.user_id
+                    )
+                    embed = await aformat_travelynx(bot, trip.user_id, trips)
+                msg = await message.fetch(bot)
+                await msg.edit(
+                    embed=embed,
+                    view=None if continue_link else TripActionsView(trips[-1]),
+                )
+
+
+hafas_retries = enrichment.RetryScheduler(rerender_trip)
+enrichment_queue = enrichment.EnrichmentQueue(config.get("enrichment_workers", 4))
 
 
 async def receive(bot):
@@ -144,8 +244,13 @@ async def receive(bot):
     travelynx and runs the live feed for the users that have enabled it"""
 
     async def handler(req):
-        user = DB.User.find(
-            token_webhook=req.headers["authorization"].removeprefix("Bearer ")
+        with DB.unit_of_work("webhook"):
+            return await handle_webhook(req)
+
+    async def handle_webhook(req):
+        user = await DB.read(
+            DB.User.find,
+            token_webhook=req.headers["authorization"].removeprefix("Bearer "),
         )
         if not user:
             print(f"unknown user {req.headers['authorization']}")
@@ -164,17 +269,18 @@ async def receive(bot):
             ):
                 raise web.HTTPNoContent()
 
-            # hopefully debug this mess eventually
+            # hopefully debug this mess eventually. only what travelynx sent us, this
+            # isn't worth asking the database or making a short link for
             print(
                 userid,
                 data["reason"],
-                get_display(bot, data["status"]),
-                generate_train_link(data["status"]),
+                get_display(bot, data["status"], get_network(data["status"], {})),
+                train_link_url(data["status"], {}),
             )
 
             # when checkin is undone, delete its message
             if data["reason"] == "undo" and not data["status"]["checkedIn"]:
-                last_trip = DB.Trip.find_last_trip_for(user.discord_id)
+                last_trip = await DB.read(DB.Trip.find_last_trip_for, user.discord_id)
                 if not last_trip.status["checkedIn"]:
                     print("sussy")
                     return web.Response(
@@ -183,22 +289,22 @@ async def receive(bot):
                         "save the journey comment once, and then finally undo your checkin. Sorry for the hassle."
                     )
 
-                messages_to_delete = DB.Message.find_all(
-                    user.discord_id, last_trip.journey_id
+                messages_to_delete = await DB.read(
+                    DB.Message.find_all, user.discord_id, last_trip.journey_id
                 )
                 for message in messages_to_delete:
                     await message.delete(bot)
-                last_trip.delete()
+                await DB.write_transaction(last_trip.delete)
 
-                if current_trips := DB.Trip.find_current_trips_for(user.discord_id):
-                    for message in DB.Message.find_all(
-                        user.discord_id, current_trips[-1].journey_id
+                if current_trips := await DB.Trip.afind_current_trips_for(
+                    user.discord_id
+                ):
+                    embed = await aformat_travelynx(bot, userid, current_trips)
+                    for message in await DB.read(
+                        DB.Message.find_all, user.discord_id, current_trips[-1].journey_id
                     ):
                         msg = await message.fetch(bot)
-                        await msg.edit(
-                            embed=format_travelynx(bot, userid, current_trips),
-                            view=None,
-                        )
+                        await msg.edit(embed=embed, view=None)
 
                 return web.Response(
                     text=f"Unpublished last checkin for {len(messages_to_delete)} channels"
@@ -207,19 +313,32 @@ async def receive(bot):
             # don't share completely private checkins, only unlisted and upwards
             if data["status"]["visibility"]["desc"] == "private":
                 # just to make sure we don't have it lying around for some reason anyway
-                if trip := DB.Trip.find(user.discord_id, zugid(data["status"])):
-                    trip.delete()
+                if trip := await DB.Trip.afind(user.discord_id, zugid(data["status"])):
+                    await DB.write_transaction(trip.delete)
                 return web.Response(
                     text=f'Not publishing private {data["reason"]} in {data["status"]["train"]["type"]} {data["status"]["train"]["no"]}'
                 )
 
-            # update database to maintain trip data
-            await handle_status_update(userid, data["reason"], data["status"])
+            # update database to maintain trip data. everything we need to ask other
+            # backends for happens in the background once we've posted the update
+            def enrich_later():
+                enrichment_queue.put(
+                    userid,
+                    lambda: enrich_in_background(userid, zugid(data["status"])),
+                )
 
-            current_trips = DB.Trip.find_current_trips_for(user.discord_id)
+            await DB.write_transaction(
+                store_status_update, userid, data["reason"], data["status"]
+            )
+            enrich_later()
+
+            current_trips = await DB.Trip.afind_current_trips_for(user.discord_id)
 
             # get all channels that live updates get pushed to for this user
-            channels = [bot.get_channel(cid) for cid in user.find_live_channel_ids()]
+            channels = [
+                bot.get_channel(cid)
+                for cid in await DB.read(user.find_live_channel_ids)
+            ]
             for channel in channels:
                 member = channel.guild.get_member(user.discord_id)
                 # don't post if the user has left or can't see the live channel
@@ -228,14 +347,14 @@ async def receive(bot):
 
                 # check if we already have a message for this particular trip
                 # edit it if it exists, otherwise create a new one and submit it into the database
-                if message := DB.Message.find(
-                    userid, zugid(data["status"]), channel.id
+                if message := await DB.read(
+                    DB.Message.find, userid, zugid(data["status"]), channel.id
                 ):
                     # if we get a checkout after another checkin has already been posted (manually)
                     # stop pretending we're at the end of the journey and link to the new ones
                     continue_link = None
-                    if newer_message := DB.Message.find_newer_than(
-                        userid, channel.id, message.message_id
+                    if newer_message := await DB.read(
+                        DB.Message.find_newer_than, userid, channel.id, message.message_id
                     ):
                         continue_link = (await newer_message.fetch(bot)).jump_url
                         current_trip_index = [
@@ -243,43 +362,55 @@ async def receive(bot):
                         ].index(zugid(data["status"]))
                         current_trips = current_trips[0 : current_trip_index + 1]
 
+                    embed = await aformat_travelynx(
+                        bot,
+                        userid,
+                        current_trips,
+                        continue_link=continue_link,
+                    )
                     msg = await message.fetch(bot)
                     await msg.edit(
-                        embed=format_travelynx(
-                            bot,
-                            userid,
-                            current_trips,
-                            continue_link=continue_link,
-                        ),
+                        embed=embed,
                         view=TripActionsView(current_trips[-1]),
                     )
                 else:
-                    embed = format_travelynx(bot, userid, current_trips)
+                    embed = await aformat_travelynx(bot, userid, current_trips)
                     if len(embed) > 4096:
                         # too long! oops! break the journey and readd our last checkin.
-                        DB.User.find(discord_id=userid).do_break_journey()
-                        await handle_status_update(
-                            userid, data["reason"], data["status"]
+                        await DB.write(user.do_break_journey)
+                        await DB.write_transaction(
+                            store_status_update, userid, data["reason"], data["status"]
+                        )
+                        # the trip we already queued got deleted and stored again without
+                        # its hafas data. the job for it may have run against the deleted
+                        # row, so enrich it again. jobs for a user run in order
+                        enrich_later()
+                        current_trips = await DB.Trip.afind_current_trips_for(
+                            user.discord_id
                         )
-                        current_trips = DB.Trip.find_current_trips_for(user.discord_id)
-                        embed = format_travelynx(bot, userid, current_trips)
+                        embed = await aformat_travelynx(bot, userid, current_trips)
 
                     message = await channel.send(
                         embed=embed,
                         view=TripActionsView(current_trips[-1]),
                     )
-                    DB.Message(
-                        zugid(data["status"]), user.discord_id, channel.id, message.id
-                    ).write()
+                    await DB.write(
+                        DB.Message(
+                            zugid(data["status"]), user.discord_id, channel.id, message.id
+                        ).write
+                    )
                     # shrink previous message to prevent clutter
                     if len(current_trips) > 1 and (
-                        prev_message := DB.Message.find(
-                            user.discord_id, current_trips[-2].journey_id, channel.id
+                        prev_message := await DB.read(
+                            DB.Message.find,
+                            user.discord_id,
+                            current_trips[-2].journey_id,
+                            channel.id,
                         )
                     ):
                         prev_msg = await prev_message.fetch(bot)
                         await prev_msg.edit(
-                            embed=format_travelynx(
+                            embed=await aformat_travelynx(
                                 bot,
                                 userid,
                                 current_trips[0:-1],
@@ -332,32 +463,31 @@ async def zug(ia, member: typing.Optional[discord.Member]):
         return
 
     await ia.response.defer()
-    async with ClientSession() as session:
-        async with session.get(
-            f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
-        ) as r:
-            if r.status == 200:
-                status = await r.json()
-                if status["checkedIn"] and (status["visibility"]["desc"] != "private"):
-                    await handle_status_update(member.id, "update", status)
-
-            current_trips = DB.Trip.find_current_trips_for(member.id)
-            if current_trips and (
-                current_trips[-1].status["checkedIn"]
-                or current_trips[-1].status["toStation"]["realTime"]
-                > datetime.utcnow().timestamp()
-            ):
-                await ia.edit_original_response(
-                    embed=format_travelynx(bot, member.id, current_trips),
-                    view=TripActionsView(current_trips[-1]),
-                )
-            else:
-                await ia.edit_original_response(
-                    embed=discord.Embed().set_author(
-                        name=f"{member.name} ist gerade nicht unterwegs",
-                        icon_url=member.avatar.url,
-                    )
+    async with get_session().get(
+        f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
+    ) as r:
+        if r.status == 200:
+            status = await r.json()
+            if status["checkedIn"] and (status["visibility"]["desc"] != "private"):
+                await handle_status_update(member.id, "update", status)
+
+        current_trips = await DB.Trip.afind_current_trips_for(member.id)
+        if current_trips and (
+            current_trips[-1].status["checkedIn"]
+            or current_trips[-1].status["toStation"]["realTime"]
+            > datetime.utcnow().timestamp()
+        ):
+            await ia.edit_original_response(
+                embed=await aformat_travelynx(bot, member.id, current_trips),
+                view=TripActionsView(current_trips[-1]),
+            )
+        else:
+            await ia.edit_original_response(
+                embed=discord.Embed().set_author(
+                    name=f"{member.name} ist gerade nicht unterwegs",
+                    icon_url=member.avatar.url,
                 )
+            )
 
 
 class TripActionsView(discord.ui.View):
@@ -390,27 +520,26 @@ class TripActionsView(discord.ui.View):
         and replaced with a disabled button for fake checkins"""
         user = DB.User.find(discord_id=self.trip.user_id)
         await ia.response.defer()
-        async with ClientSession() as session:
-            async with session.get(
-                f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
-            ) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    if data["checkedIn"] and self.trip.journey_id == zugid(data):
-                        await handle_status_update(self.trip.user_id, "update", data)
-                        self.trip.fetch_hafas_data(force=True)
-                        await ia.edit_original_response(
-                            embed=format_travelynx(
-                                bot,
-                                self.trip.user_id,
-                                DB.Trip.find_current_trips_for(self.trip.user_id),
-                            ),
-                            view=self,
-                        )
-                    else:
-                        await ia.followup.send(
-                            "Die Fahrt ist bereits zu Ende.", ephemeral=True
-                        )
+        async with get_session().get(
+            f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
+        ) as r:
+            if r.status == 200:
+                data = await r.json()
+                if data["checkedIn"] and self.trip.journey_id == zugid(data):
+                    await handle_status_update(self.trip.user_id, "update", data)
+                    await self.trip.fetch_hafas_data(force=True)
+                    await ia.edit_original_response(
+                        embed=await aformat_travelynx(
+                            bot,
+                            self.trip.user_id,
+                            await DB.Trip.afind_current_trips_for(self.trip.user_id),
+                        ),
+                        view=self,
+                    )
+                else:
+                    await ia.followup.send(
+                        "Die Fahrt ist bereits zu Ende.", ephemeral=True
+                    )
 
     @discord.ui.button(label="Copy", style=discord.ButtonStyle.secondary)
     async def manualcopy(self, ia, _):
@@ -818,20 +947,21 @@ async def manualtrip(
     if network:
         status["network"] = network
     webhook = {"reason": "checkout", "status": status}
-    async with ClientSession() as session:
-        async with session.post(
-            "http://localhost:6005/travelynx",
-            json=webhook,
-            headers={"Authorization": f"Bearer {user.token_webhook}"},
-        ) as r:
-            await ia.edit_original_response(content=f"{r.status} {await r.text()}")
+    async with get_session().post(
+        "http://localhost:6005/travelynx",
+        # our own webhook handler takes however long it takes
+        timeout=ClientTimeout(),
+        json=webhook,
+        headers={"Authorization": f"Bearer {user.token_webhook}"},
+    ) as r:
+        await ia.edit_original_response(content=f"{r.status} {await r.text()}")
 
 
 def render_patched_train(trip, patch):
     "helper method to render a preview of how a train will look with a different patch applied"
     status = DB.json_patch_dicts(patch, trip.get_unpatched_status())
     user_tz = DB.User.find(trip.user_id).get_timezone()
-    display = get_display(bot, status)
+    display = get_display(bot, status, get_network(status, trip.hafas_data))
     link = generate_train_link(status)
     departure = format_time(
         status["fromStation"]["scheduledTime"],
@@ -896,16 +1026,17 @@ class UndoView(discord.ui.View):
         status = self.trip.get_unpatched_status()
         status["checkedIn"] = True
         DB.Trip.upsert(self.user.discord_id, status)
-        async with ClientSession() as session:
-            status["checkedIn"] = False
-            async with session.post(
-                "http://localhost:6005/travelynx",
-                json={"reason": "undo", "status": status},
-                headers={"Authorization": f"Bearer {self.user.token_webhook}"},
-            ) as r:
-                await ia.response.edit_message(
-                    content=f"{r.status} {await r.text()}", embed=None, view=None
-                )
+        status["checkedIn"] = False
+        async with get_session().post(
+            "http://localhost:6005/travelynx",
+            # our own webhook handler takes however long it takes
+            timeout=ClientTimeout(),
+            json={"reason": "undo", "status": status},
+            headers={"Authorization": f"Bearer {self.user.token_webhook}"},
+        ) as r:
+            await ia.response.edit_message(
+                content=f"{r.status} {await r.text()}", embed=None, view=None
+            )
 
 
 @journey.command()
@@ -940,59 +1071,60 @@ async def delay(ia, departure: typing.Optional[int], arrival: typing.Optional[in
 
     trip = DB.Trip.find(trip.user_id, trip.journey_id)
     reason = "update" if trip.status["checkedIn"] else "checkout"
-    async with ClientSession() as session:
-        async with session.post(
-            "http://localhost:6005/travelynx",
-            json={"reason": reason, "status": trip.get_unpatched_status()},
-            headers={"Authorization": f"Bearer {user.token_webhook}"},
-        ) as r:
-            if r.status == 200:
-                display = get_display(bot, trip.status)
-                link = generate_train_link(trip.status)
-                headsign = trip.fetch_headsign()
-                train_line = f"**{display['line']}**" if display["line"] else ""
-                dep_delay = format_time(
-                    trip.status["fromStation"]["scheduledTime"],
-                    trip.status["fromStation"]["realTime"],
-                    timezone=user.get_timezone(),
-                )[8:-2]
-                arr_delay = format_time(
-                    trip.status["toStation"]["scheduledTime"],
-                    trip.status["toStation"]["realTime"],
-                    timezone=user.get_timezone(),
-                )[8:-2]
-
-                embed = discord.Embed(
-                    description=f"{display['emoji']} {train_line} **» {headsign}** "
-                    f"is delayed by **{dep_delay or '+0′'}/{arr_delay or '+0′'}**.",
-                    color=train_type_color["SB"],
-                ).set_author(
-                    name=f"{ia.user.name} ist {'nicht ' if len(dep_delay+arr_delay) == 0 else ''}verspätet",
-                    icon_url=ia.user.avatar.url,
-                )
-
-                server = DB.Server.find(ia.guild.id)
-                if server.live_channel and (
-                    msg := DB.Message.find(
-                        trip.user_id, trip.journey_id, server.live_channel
-                    )
-                ):
-                    embed.description += (
-                        f"\n**current journey:** {(await msg.fetch(bot)).jump_url}"
-                    )
+    async with get_session().post(
+        "http://localhost:6005/travelynx",
+        # our own webhook handler takes however long it takes
+        timeout=ClientTimeout(),
+        json={"reason": reason, "status": trip.get_unpatched_status()},
+        headers={"Authorization": f"Bearer {user.token_webhook}"},
+    ) as r:
+        if r.status == 200:
+            display = get_display(bot, trip.status, trip.get_network())
+            link = generate_train_link(trip.status)
+            headsign = trip.fetch_headsign()
+            train_line = f"**{display['line']}**" if display["line"] else ""
+            dep_delay = format_time(
+                trip.status["fromStation"]["scheduledTime"],
+                trip.status["fromStation"]["realTime"],
+                timezone=user.get_timezone(),
+            )[8:-2]
+            arr_delay = format_time(
+                trip.status["toStation"]["scheduledTime"],
+                trip.status["toStation"]["realTime"],
+                timezone=user.get_timezone(),
+            )[8:-2]
+
+            embed = discord.Embed(
+                description=f"{display['emoji']} {train_line} **» {headsign}** "
+                f"is delayed by **{dep_delay or '+0′'}/{arr_delay or '+0′'}**.",
+                color=train_type_color["SB"],
+            ).set_author(
+                name=f"{ia.user.name} ist {'nicht ' if len(dep_delay+arr_delay) == 0 else ''}verspätet",
+                icon_url=ia.user.avatar.url,
+            )
 
-                await ia.edit_original_response(content=None, embed=embed)
-            else:
-                await ia.edit_original_response(
-                    content=f"{r.status} {await r.text()}",
+            server = DB.Server.find(ia.guild.id)
+            if server.live_channel and (
+                msg := DB.Message.find(
+                    trip.user_id, trip.journey_id, server.live_channel
                 )
+            ):
+                embed.description += (
+                    f"\n**current journey:** {(await msg.fetch(bot)).jump_url}"
+                )
+
+            await ia.edit_original_response(content=None, embed=embed)
+        else:
+            await ia.edit_original_response(
+                content=f"{r.status} {await r.text()}",
+            )
 
 
 async def composition_autocomplete(ia, current):
     if (
         (user := DB.User.find(ia.user.id))
         and (trip := DB.Trip.find_last_trip_for(user.discord_id))
-        and (network := get_network(trip.status))
+        and (network := trip.get_network())
     ):
         numbers = [int(s.strip()) for s in current.split("+") if s]
         composition_enriched = " + ".join(
@@ -1231,24 +1363,25 @@ class EditTripView(discord.ui.View):
             self.trip.user_id, self.trip.journey_id
         )  # update, just in case
         reason = "update" if self.trip.status["checkedIn"] else "checkout"
-        async with ClientSession() as session:
-            async with session.post(
-                "http://localhost:6005/travelynx",
-                json={"reason": reason, "status": self.trip.get_unpatched_status()},
-                headers={
-                    "Authorization": f"Bearer {DB.User.find(self.trip.user_id).token_webhook}"
-                },
-            ) as r:
-                if self.quiet:
-                    return
-                if ia.response.is_done():
-                    await ia.edit_original_response(
-                        content=f"{r.status} {await r.text()}", embed=None, view=None
-                    )
-                else:
-                    await ia.response.edit_message(
-                        content=f"{r.status} {await r.text()}", embed=None, view=None
-                    )
+        async with get_session().post(
+            "http://localhost:6005/travelynx",
+            # our own webhook handler takes however long it takes
+            timeout=ClientTimeout(),
+            json={"reason": reason, "status": self.trip.get_unpatched_status()},
+            headers={
+                "Authorization": f"Bearer {DB.User.find(self.trip.user_id).token_webhook}"
+            },
+        ) as r:
+            if self.quiet:
+                return
+            if ia.response.is_done():
+                await ia.edit_original_response(
+                    content=f"{r.status} {await r.text()}", embed=None, view=None
+                )
+            else:
+                await ia.response.edit_message(
+                    content=f"{r.status} {await r.text()}", embed=None, view=None
+                )
 
     @discord.ui.button(
         label="Open the manual editor instead.", style=discord.ButtonStyle.grey
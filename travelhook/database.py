@@ -1,13 +1,21 @@
 # pylint: disable=missing-function-docstring
 "contains and encapsulates database accesses"
+import array
 import asyncio
-import aiohttp
+import bisect
 import collections
+import contextlib
+import contextvars
+import copy
+import functools
 import json
 import sqlite3
 import shlex
 import subprocess
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, astuple
 from datetime import datetime, timedelta, timezone
 from enum import IntEnum
@@ -19,6 +27,7 @@ from haversine import haversine
 
 from .helpers import (
     config,
+    get_session,
     zugid,
     tz,
     random_id,
@@ -26,6 +35,7 @@ from .helpers import (
     format_composition_element,
     db_replace_group_classes,
     describe_class,
+    LRUCache,
 )
 from .format import get_network, train_types_config
 from . import oebb_wr
@@ -34,34 +44,469 @@ from bs4 import BeautifulSoup
 import re
 
 DB = None
+db_readers = None
+db_writer = None
+
+
+class ThreadLocalConnection:
+    """stands in for a sqlite3 connection, but gives every thread its own one since they
+    can't be shared. this way the same queries work on the event loop and in the db threads"""
+
+    def __init__(self, path, tuning):
+        self.path = path
+        self.tuning = tuning
+        self.local = threading.local()
+
+    def connection(self):
+        if not (connection := getattr(self.local, "connection", None)):
+            connection = sqlite3.connect(
+                self.path,
+                isolation_level=None,
+                timeout=self.tuning["busy_timeout"] / 1000,
+                cached_statements=self.tuning["cached_statements"],
+            )
+            connection.row_factory = sqlite3.Row
+            for pragma in ("journal_mode", "synchronous", "mmap_size", "cache_size"):
+                connection.execute(f"PRAGMA {pragma} = {self.tuning[pragma]}")
+            self.local.connection = connection
+        return connection
+
+    def execute(self, *args):
+        if unit := current_unit.get():
+            unit.queries += 1
+        return self.connection().execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """commit everything in the block at once, or nothing if it raises. blocks inside
+        another transaction just become part of that one"""
+        connection = self.connection()
+        if connection.in_transaction:
+            yield
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
 
 
 def connect(path):
-    global DB
-    DB = sqlite3.connect(path, isolation_level=None)
-    DB.row_factory = sqlite3.Row
+    global DB, db_readers, db_writer
+    tuning = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 256 * 1024 * 1024,
+        # negative means KiB instead of pages
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+        "cached_statements": 256,
+        "readers": 2,
+    } | config.get("sqlite", {})
+    DB = ThreadLocalConnection(path, tuning)
+    # in WAL mode readers don't wait for the writer or each other, so renders can go
+    # ahead while we write. writes all go through one thread and queue up there instead
+    # of fighting over the database lock.
+    db_readers = ThreadPoolExecutor(tuning["readers"], thread_name_prefix="db-read")
+    db_writer = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+    oebb_stopfinder_results.update(
+        {
+            row["name"]: (row["eva"], row["found_at"])
+            for row in DB.execute("SELECT * FROM oebb_stopfinder")
+        }
+    )
+    # only ever change through migrations, and rendering asks for them all the time
+    cities.update(row["name"] for row in DB.execute("SELECT name FROM cities"))
+    cts_stops.update(
+        {
+            row["name"]: row["translated"]
+            for row in DB.execute("SELECT * FROM cts_stops")
+        }
+    )
+
+
+async def read(fn, *args, **kwargs):
+    "run fn, which mostly reads from the database, in a db thread instead of on the event loop"
+    # run_in_executor doesn't take our context along by itself, we need it for the unit of work
+    return await asyncio.get_running_loop().run_in_executor(
+        db_readers,
+        functools.partial(contextvars.copy_context().run, fn, *args, **kwargs),
+    )
+
+
+async def write(fn, *args, **kwargs):
+    "run fn, which writes to the database, in the db writer thread instead of on the event loop"
+    return await asyncio.get_running_loop().run_in_executor(
+        db_writer,
+        functools.partial(contextvars.copy_context().run, fn, *args, **kwargs),
+    )
+
+
+async def write_transaction(fn, *args, **kwargs):
+    """like write(), but everything fn writes is committed in one transaction. fn runs in
+    the writer thread and can't await anything, so we never hold the write lock while
+    waiting for the network, and readers never see only half of what fn wrote"""
+
+    def run():
+        with DB.transaction():
+            return fn(*args, **kwargs)
+
+    return await write(run)
+
+
+class UnitOfWork:
+    """the rows we loaded while handling one webhook or interaction. everything that asks
+    for the same user or trip in the meantime gets the same object back instead of asking
+    the database again. writes forget the rows they touch so they get loaded fresh."""
+
+    def __init__(self, name):
+        self.name = name
+        self.loaded = {}
+        self.queries = 0
+        self.reused = 0
+
+    def get(self, key, load):
+        if key in self.loaded:
+            self.reused += 1
+        else:
+            self.loaded[key] = load()
+        return self.loaded[key]
+
+    def remember(self, key, obj):
+        "obj, unless we already have something else for key, then that"
+        return self.loaded.setdefault(key, obj)
+
+    def forget(self, *prefix):
+        for key in [key for key in self.loaded if key[: len(prefix)] == prefix]:
+            del self.loaded[key]
+
+    def report(self):
+        if config.get("log_queries", False):
+            print(
+                f"{self.name}: {self.queries} queries, {self.reused} rows reused, "
+                f"user cache at {user_cache.hits} hits, {user_cache.misses} misses"
+            )
+
+
+current_unit = contextvars.ContextVar("current_unit", default=None)
+
+
+def begin_unit_of_work(name):
+    """start a unit of work for the current task and everything it awaits. for when
+    there's no block to put unit_of_work() around because the task ends with it anyway.
+    the unit gets reported once the task is done, however it ended"""
+    unit = UnitOfWork(name)
+    current_unit.set(unit)
+    asyncio.current_task().add_done_callback(lambda _: unit.report())
+    return unit
+
+
+@contextlib.contextmanager
+def unit_of_work(name):
+    unit = UnitOfWork(name)
+    token = current_unit.set(unit)
+    try:
+        yield unit
+    finally:
+        current_unit.reset(token)
+        unit.report()
+
+
+def identity(key, load):
+    "load() unless the current unit of work already has key"
+    if unit := current_unit.get():
+        return unit.get(key, load)
+    return load()
+
+
+def remember(key, obj):
+    if unit := current_unit.get():
+        return unit.remember(key, obj)
+    return obj
+
+
+def forget(*prefix):
+    if unit := current_unit.get():
+        unit.forget(*prefix)
 
 
 all_train_types = train_types_config["train_types"]
 all_train_types = set([tt.get("type") for tt in all_train_types if tt.get("type")])
 
 
+def merge_patch(target, patch, in_place=False):
+    """apply an RFC 7386 JSON merge patch to target, same as sqlite's json_patch(). unless
+    in_place is set, target stays untouched and only the dicts on the way to a change are
+    copied, everything else is shared between target and the result."""
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    elif not in_place:
+        target = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value, in_place)
+    return target
+
+
 def json_patch_dicts(patch, old_dict):
-    return json.loads(
-        DB.execute(
-            "SELECT json_patch(?,?) AS newpatch",
-            (
-                json.dumps(old_dict),
-                json.dumps(patch),
-            ),
-        ).fetchone()["newpatch"]
+    return merge_patch(old_dict, patch)
+
+
+class PerlWorkerPool:
+    """keeps a few json-hafas-worker.pl processes around so we only pay for starting perl and
+    loading the Travel::Status modules once, instead of for every single stationboard or trip.
+    at most `size` requests run at once, everyone else waits for a worker to become idle."""
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(size)
+
+    async def spawn(self):
+        return await asyncio.create_subprocess_exec(
+            "json-hafas-worker.pl",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            # a trip with its polyline easily exceeds the default 64 KiB line limit
+            limit=2**24,
+        )
+
+    async def request(self, script, *args, timeout=None):
+        """run one of our json-*.pl scripts with args on a worker, returns its raw output,
+        or None if it took longer than timeout seconds. if the worker died on us, replace
+        it and try once more. if it times out or we get cancelled, the worker is killed
+        since we can't know what state it's in anymore."""
+        line = json.dumps({"script": script, "args": [str(arg) for arg in args]})
+        async with self.semaphore:
+            worker = self.idle.pop() if self.idle else None
+            for _ in range(2):
+                if not worker or worker.returncode is not None:
+                    worker = await self.spawn()
+                output = b""
+                try:
+                    worker.stdin.write(line.encode() + b"\n")
+                    await worker.stdin.drain()
+                    output = await asyncio.wait_for(
+                        worker.stdout.readline(), timeout or self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    print(f"perl worker {worker.pid} timed out on {script} {args}")
+                    await self.discard(worker)
+                    return None
+                except asyncio.CancelledError:
+                    await self.discard(worker)
+                    raise
+                except ValueError:
+                    # the reply is longer than the line limit. asking again gets us the
+                    # same reply, so don't
+                    traceback.print_exc()
+                    await self.discard(worker)
+                    return b""
+                except OSError:
+                    traceback.print_exc()
+
+                if output:
+                    self.idle.append(worker)
+                    return output
+                print(f"perl worker {worker.pid} for {script} died, restarting")
+                await self.discard(worker)
+                worker = None
+            return b""
+
+    async def discard(self, worker):
+        "kill worker if it's still running and wait for it, so it doesn't stay around as a zombie"
+        if worker.returncode is None:
+            worker.kill()
+        # also when we're being cancelled, the process needs to be waited for either way
+        await asyncio.shield(worker.wait())
+
+
+perl_workers = PerlWorkerPool(
+    config.get("perl_workers", 2), config.get("backend_timeout", 30)
+)
+
+
+class Stationboard:
+    """a departure board as returned by json-hafas-stationboard.pl, with its trains indexed by
+    scheduled departure so we can look them up directly instead of scanning all of them"""
+
+    def __init__(self, board, timestamp):
+        self.trains = board.get("trains", [])
+        self.error_string = board.get("error_string") if not self.trains else None
+        self.by_scheduled = collections.defaultdict(list)
+        for i, train in enumerate(self.trains):
+            self.by_scheduled[train["scheduled"]].append(i)
+        self.departures = sorted(self.by_scheduled)
+        # the backends only return departures from the requested time onwards
+        # and cut off at some point, so this is the window we can answer for
+        self.start = timestamp
+        self.end = self.departures[-1] if self.departures else timestamp
+        self.expires = time.monotonic() + config.get("stationboard_ttl", 300)
+
+    def covers(self, timestamp):
+        # the last minute of a board might be cut off, stay away from it
+        return self.start <= timestamp and timestamp + 60 < self.end
+
+    def departing_at(self, scheduled):
+        return [self.trains[i] for i in self.by_scheduled.get(scheduled, [])]
+
+    def departing_around(self, scheduled, tolerance):
+        "all trains within tolerance seconds of scheduled, in the order the backend gave them"
+        lo = bisect.bisect_left(self.departures, scheduled - tolerance)
+        hi = bisect.bisect_right(self.departures, scheduled + tolerance)
+        return [
+            self.trains[i]
+            for i in sorted(
+                i for dep in self.departures[lo:hi] for i in self.by_scheduled[dep]
+            )
+        ]
+
+
+stationboard_cache = collections.defaultdict(list)
+
+
+async def get_stationboard(backend_name, station_id, timestamp, force=False):
+    """fetch a departure board, reusing a recent one for the same station if it covers timestamp.
+    with force, always fetch a new one: when retrying a trip we didn't find on the board,
+    the cached board won't have it either.
+    returns None if the perl script broke or timed out, otherwise a Stationboard, possibly with error_string set"""
+    key = (backend_name, str(station_id))
+    now = time.monotonic()
+    stationboard_cache[key] = [sb for sb in stationboard_cache[key] if sb.expires > now]
+    for stationboard in stationboard_cache[key]:
+        if stationboard.covers(timestamp) and not force:
+            return stationboard
+
+    sb = await perl_workers.request(
+        "json-hafas-stationboard.pl", backend_name, station_id, timestamp
+    )
+    if sb is None:
+        return None
+    stationboard = {}
+    try:
+        stationboard = json.loads(sb)
+    except:  # pylint: disable=bare-except
+        print(f"{backend_name} stationboard perl broke:\n{sb}")
+        traceback.print_exc()
+        return None
+    if "error_code" in stationboard:
+        print(f"{backend_name} stationboard perl broke:\n{stationboard}")
+    stationboard = Stationboard(stationboard, timestamp)
+
+    if stationboard.trains:
+        for k in [k for k, boards in stationboard_cache.items() if not boards]:
+            del stationboard_cache[k]
+        stationboard_cache[key].append(stationboard)
+    return stationboard
+
+
+async def fetch_trip(backend_name, trip_id):
+    hafas = await perl_workers.request("json-hafas.pl", backend_name, trip_id)
+    if hafas is None:
+        return None
+    status = {}
+    try:
+        status = json.loads(hafas)
+        if "error_string" in status:
+            print(f"{backend_name} trip perl broke:\n{status}")
+            return None
+    except:  # pylint: disable=bare-except
+        print(f"{backend_name} trip perl broke:\n{hafas}")
+        traceback.print_exc()
+        return None
+
+    now = time.monotonic()
+    for key in [key for key, (expires, _) in trip_cache.items() if expires <= now]:
+        del trip_cache[key]
+    trip_cache[(backend_name, trip_id)] = (now + config.get("trip_ttl", 60), status)
+    return status
+
+
+trip_cache = {}
+trip_fetches = {}
+
+
+async def get_trip(backend_name, trip_id):
+    """fetch a trip, sharing the result with everyone else who's on the same train.
+    concurrent requests for the same trip wait for the same fetch, and the result is
+    kept around for trip_ttl seconds. everyone gets their own copy to mess with."""
+    key = (backend_name, trip_id)
+    if (cached := trip_cache.get(key)) and cached[0] > time.monotonic():
+        return copy.deepcopy(cached[1])
+
+    if key not in trip_fetches:
+        # shared with everyone on the train, so it doesn't belong to the caller's unit of work
+        trip_fetches[key] = asyncio.get_running_loop().create_task(
+            fetch_trip(backend_name, trip_id), context=contextvars.Context()
+        )
+        trip_fetches[key].add_done_callback(lambda _: trip_fetches.pop(key, None))
+    # don't let one impatient caller cancel the fetch for everyone else
+    status = await asyncio.shield(trip_fetches[key])
+    return copy.deepcopy(status)
+
+
+# name -> (eva or None, unix timestamp), mirrors the oebb_stopfinder table
+oebb_stopfinder_results = {}
+# stations may get added to ÖBB HAFAS eventually, so don't trust "not found" forever
+OEBB_STOPFINDER_RETRY_MISSING = timedelta(days=7).total_seconds()
+
+
+async def oebb_stopfinder(name):
+    """find a stop by name in ÖBB HAFAS, for stations that have a different ID there.
+    returns its eva or None. results are remembered in the database, so we only ask once."""
+    if name in oebb_stopfinder_results:
+        eva, found_at = oebb_stopfinder_results[name]
+        if eva or found_at > time.time() - OEBB_STOPFINDER_RETRY_MISSING:
+            return eva
+
+    hafas_stations = await perl_workers.request("json-hafas-stopfinder.pl", "ÖBB", name)
+    if hafas_stations is None:
+        return None
+    stations = None
+    try:
+        stations = json.loads(hafas_stations)
+    except:  # pylint: disable=bare-except
+        print(f"alternative ÖBB station search perl broke:\n{hafas_stations}")
+        traceback.print_exc()
+        return None
+    if not stations.get("stops"):
+        print(f"alternative ÖBB station search broke:\n{stations}")
+        if stations.get("error_string"):
+            # actually broke instead of not finding anything, don't remember that
+            return None
+
+    eva = stations["stops"][0]["eva"] if stations.get("stops") else None
+    found_at = int(time.time())
+    oebb_stopfinder_results[name] = (eva, found_at)
+    await write(
+        DB.execute,
+        "INSERT OR REPLACE INTO oebb_stopfinder(name, eva, found_at) VALUES(?,?,?)",
+        (name, eva, found_at),
     )
+    return eva
 
 
 re_british_train_no = re.compile(r"[A-Z]\d{5}$")
 re_british_class_numbers = re.compile(r"(\d{3})(\d{3})")
 
 
+# users, their privacy settings and live channels get looked up for nearly every webhook
+# and interaction, but only ever change through the User methods below
+user_cache = LRUCache(
+    config.get("user_cache_size", 1024), enabled=config.get("user_cache", True)
+)
+
+
 @dataclass
 class Server:
     "servers the bot is enabled on"
@@ -75,10 +520,13 @@ class Server:
 
     @classmethod
     def find(cls, server_id):
-        row = DB.execute(
-            "SELECT * FROM servers WHERE server_id = ?", (server_id,)
-        ).fetchone()
-        return cls(**row)
+        def load():
+            row = DB.execute(
+                "SELECT * FROM servers WHERE server_id = ?", (server_id,)
+            ).fetchone()
+            return cls(**row)
+
+        return identity(("servers", server_id), load)
 
     def as_discord_obj(self):
         return discord.Object(id=self.server_id)
@@ -150,21 +598,38 @@ class User:
 
     @classmethod
     def find(cls, discord_id=None, token_webhook=None):
-        row = None
         if discord_id:
-            row = DB.execute(
-                "SELECT * FROM users WHERE discord_id = ?", (discord_id,)
-            ).fetchone()
+
+            def load():
+                if row := user_cache.get(
+                    ("users", discord_id),
+                    lambda: DB.execute(
+                        "SELECT * FROM users WHERE discord_id = ?", (discord_id,)
+                    ).fetchone(),
+                ):
+                    return cls(**row)
+                return None
+
+            return identity(("users", discord_id), load)
         elif token_webhook:
-            row = DB.execute(
-                "SELECT * FROM users WHERE token_webhook = ?", (token_webhook,)
-            ).fetchone()
+            if row := user_cache.get(
+                ("token_webhook", token_webhook),
+                lambda: DB.execute(
+                    "SELECT * FROM users WHERE token_webhook = ?", (token_webhook,)
+                ).fetchone(),
+            ):
+                user = cls(**row)
+                return remember(("users", user.discord_id), user)
+            return None
         else:
             raise ValueError()
 
-        if row:
-            return cls(**row)
-        return None
+    def forget(self):
+        "drop our row from the caches after writing to it"
+        user_cache.invalidate(
+            ("users", self.discord_id), ("token_webhook", self.token_webhook)
+        )
+        forget("users", self.discord_id)
 
     def write(self):
         "insert the manually created user object into the database as a fresh registration"
@@ -172,12 +637,16 @@ class User:
             "INSERT INTO users (discord_id, token_status, token_webhook, token_travel, break_journey, suggestions, show_train_numbers, timezone) VALUES(?,?,?,?,?,?,?,?)",
             astuple(self),
         )
+        self.forget()
 
     def find_privacy_for(self, server_id):
-        if row := DB.execute(
-            "SELECT privacy_level FROM privacy WHERE user_id = ? AND server_id = ?",
-            (self.discord_id, server_id),
-        ).fetchone():
+        if row := user_cache.get(
+            ("privacy", self.discord_id, server_id),
+            lambda: DB.execute(
+                "SELECT privacy_level FROM privacy WHERE user_id = ? AND server_id = ?",
+                (self.discord_id, server_id),
+            ).fetchone(),
+        ):
             return Privacy(row["privacy_level"])
         return Privacy.ME
 
@@ -187,37 +656,59 @@ class User:
             "ON CONFLICT DO UPDATE SET privacy_level=excluded.privacy_level",
             (self.discord_id, server_id, int(level)),
         )
+        user_cache.invalidate(
+            ("privacy", self.discord_id, server_id), ("live_channels", self.discord_id)
+        )
 
     def set_break_mode(self, break_mode: BreakMode):
         DB.execute(
             "UPDATE users SET break_journey = ? WHERE discord_id = ?",
             (break_mode, self.discord_id),
         )
+        self.forget()
 
-    def do_break_journey(self):
-        "Break a journey, deleting stored trips and messages up to this point."
-        DB.execute("DELETE FROM trips WHERE user_id = ?", (self.discord_id,))
-        DB.execute("DELETE FROM messages WHERE user_id = ?", (self.discord_id,))
+    def do_break_journey(self, keep=None):
+        """Break a journey, deleting stored trips and messages up to this point.
+        The trip with the journey id keep stays, as the start of the next journey."""
+        with DB.transaction():
+            DB.execute(
+                "DELETE FROM trips WHERE user_id = ? AND journey_id IS NOT ?",
+                (self.discord_id, keep),
+            )
+            DB.execute(
+                "DELETE FROM polylines WHERE user_id = ? AND journey_id IS NOT ?",
+                (self.discord_id, keep),
+            )
+            DB.execute(
+                "DELETE FROM messages WHERE user_id = ? AND journey_id IS NOT ?",
+                (self.discord_id, keep),
+            )
+        forget("trips", self.discord_id)
 
     def set_show_train_numbers(self, show_train_numbers: bool):
         DB.execute(
             "UPDATE users SET show_train_numbers = ? WHERE discord_id = ?",
             (show_train_numbers, self.discord_id),
         )
+        self.forget()
 
     def set_import_token(self, token: Optional[str]):
         DB.execute(
             "UPDATE users SET token_travel = ? WHERE discord_id = ?",
             (token, self.discord_id),
         )
+        self.forget()
 
     def find_live_channel_ids(self):
-        rows = DB.execute(
-            "SELECT servers.live_channel FROM servers JOIN privacy on servers.server_id = privacy.server_id "
-            "WHERE privacy.user_id = ? AND privacy.privacy_level = ?;",
-            (self.discord_id, Privacy.LIVE),
-        ).fetchall()
-        return [row["live_channel"] for row in rows]
+        def load():
+            rows = DB.execute(
+                "SELECT servers.live_channel FROM servers JOIN privacy on servers.server_id = privacy.server_id "
+                "WHERE privacy.user_id = ? AND privacy.privacy_level = ?;",
+                (self.discord_id, Privacy.LIVE),
+            ).fetchall()
+            return tuple(row["live_channel"] for row in rows)
+
+        return list(user_cache.get(("live_channels", self.discord_id), load))
 
     def get_lock(self):
         return self.Locks[self.discord_id]
@@ -228,6 +719,7 @@ class User:
             "UPDATE users SET suggestions = ? WHERE discord_id = ?",
             (self.suggestions, self.discord_id),
         )
+        self.forget()
 
     def get_timezone(self):
         return ZoneInfo(self.timezone)
@@ -238,6 +730,11 @@ class User:
             "UPDATE users SET timezone = ? WHERE discord_id = ?",
             (self.timezone, self.discord_id),
         )
+        self.forget()
+
+
+cities = set()
+cts_stops = {}
 
 
 @dataclass
@@ -247,12 +744,8 @@ class City:
 
     @classmethod
     def find(cls, name):
-        row = DB.execute(
-            "SELECT name FROM cities WHERE name = ?",
-            (name,),
-        ).fetchone()
-        if row:
-            return cls(**row)
+        if name in cities:
+            return cls(name)
         return None
 
 
@@ -264,11 +757,7 @@ class CTSStop:
 
     @classmethod
     def translate(cls, name):
-        row = DB.execute("SELECT * FROM cts_stops WHERE name = ?", (name,)).fetchone()
-        if row:
-            return cls(**row).translated
-        else:
-            return None
+        return cts_stops.get(name)
 
 
 @dataclass
@@ -292,6 +781,36 @@ class Tram:
             return row["description"]
 
 
+class LazyJSON:
+    """for dataclass fields that get JSON text from the database. the text is only decoded
+    once someone actually reads the field, since that can be a lot for hafas_data"""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            # tell dataclass we're not a default value
+            raise AttributeError(self.name)
+        value = obj.__dict__[self.name]
+        if isinstance(value, str):
+            value = obj.__dict__[self.name] = json.loads(value)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
+@dataclass
+class CompositionResult:
+    """what a composition provider found out. the providers run concurrently on the event
+    loop, so they leave writing it to Trip.save_composition(): the patch for our status,
+    the page a composition in it links to, and the train's name to show as a message"""
+    patch: dict
+    link: Optional[str] = None
+    train_name: Optional[str] = None
+
+
 @dataclass
 class Trip:
     "user-trips the bot knows about"
@@ -307,37 +826,78 @@ class Trip:
     to_lat: float
     to_lon: float
     headsign: str
-    status_patch: str
-    hafas_data: str
-
-    def __post_init__(self):
-        self.status = json.loads(self.travelynx_status)
-        self.status_patch = json.loads(self.status_patch)
-        self.hafas_data = json.loads(self.hafas_data)
-        if (not self.status["train"]["line"]) and (line := self.hafas_data.get("line")):
-            self.status["train"]["line"] = line
+    status_patch: str = LazyJSON()
+    hafas_data: str = LazyJSON()
+    unpatched_status: str
+    network: Optional[str]
+
+    @functools.cached_property
+    def status(self):
+        status = json.loads(self.travelynx_status)
+        if (not status["train"]["line"]) and (line := self.hafas_data.get("line")):
+            status["train"]["line"] = line
+        return status
 
     @classmethod
     def find(cls, user_id, journey_id):
+        def load():
+            row = DB.execute(
+                "SELECT journey_id, user_id, patched_status as travelynx_status, "
+                "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data, "
+                "travelynx_status as unpatched_status, network "
+                "FROM trips WHERE user_id = ? AND journey_id = ?",
+                (user_id, journey_id),
+            ).fetchone()
+            if row:
+                return cls(**row)
+            return None
+
+        return identity(("trips", user_id, journey_id), load)
+
+    def refresh(self):
+        """load this trip from the database again, past the identity map. writes worked out
+        from a trip we loaded before waiting on the network do this first in their transaction,
+        so they don't overwrite a newer status a webhook stored meanwhile.
+        returns False if the trip is gone by now"""
         row = DB.execute(
-            "SELECT journey_id, user_id, json_patch(travelynx_status, status_patch) as travelynx_status, "
-            "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data "
+            "SELECT journey_id, user_id, patched_status as travelynx_status, "
+            "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data, "
+            "travelynx_status as unpatched_status, network "
             "FROM trips WHERE user_id = ? AND journey_id = ?",
-            (user_id, journey_id),
+            (self.user_id, self.journey_id),
         ).fetchone()
-        if row:
-            return cls(**row)
-        return None
+        if not row:
+            return False
+        for key in row.keys():
+            setattr(self, key, row[key])
+        self.__dict__.pop("status", None)
+        return True
 
     @classmethod
     def find_current_trips_for(cls, user_id):
-        rows = DB.execute(
-            "SELECT journey_id, user_id, json_patch(travelynx_status, status_patch) as travelynx_status, "
-            "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data "
-            "FROM trips WHERE user_id = ? ORDER BY json_patch(travelynx_status, status_patch) ->> '$.fromStation.realTime' ASC",
-            (user_id,),
-        ).fetchall()
-        return [cls(**row) for row in rows]
+        def load():
+            rows = DB.execute(
+                "SELECT journey_id, user_id, patched_status as travelynx_status, "
+                "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data, "
+                "travelynx_status as unpatched_status, network "
+                "FROM trips WHERE user_id = ? ORDER BY departure ASC",
+                (user_id,),
+            ).fetchall()
+            return [
+                remember(("trips", user_id, row["journey_id"]), cls(**row))
+                for row in rows
+            ]
+
+        # callers slice this up, they shouldn't slice up everyone else's
+        return list(identity(("trips", user_id), load))
+
+    @classmethod
+    async def afind(cls, user_id, journey_id):
+        return await read(cls.find, user_id, journey_id)
+
+    @classmethod
+    async def afind_current_trips_for(cls, user_id):
+        return await read(cls.find_current_trips_for, user_id)
 
     @classmethod
     def find_last_trip_for(cls, user_id):
@@ -345,17 +905,31 @@ class Trip:
             return current_trips[-1]
         return None
 
+    @classmethod
+    def find_failed_hafas(cls, since):
+        "trips departing after the unix timestamp since that we have no hafas data for"
+        rows = DB.execute(
+            "SELECT journey_id, user_id, patched_status as travelynx_status, "
+            "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data, "
+            "travelynx_status as unpatched_status, network "
+            "FROM trips WHERE from_time > ? AND hafas_data ->> '$.failedhafas'",
+            (since,),
+        ).fetchall()
+        return [cls(**row) for row in rows]
+
     @classmethod
     def upsert(cls, userid, status):
         DB.execute(
-            "INSERT INTO trips(journey_id, user_id, travelynx_status, from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon) "
-            "VALUES(?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT DO UPDATE SET travelynx_status=excluded.travelynx_status, "
+            "INSERT INTO trips(journey_id, user_id, travelynx_status, patched_status, from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon) "
+            "VALUES(?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT DO UPDATE SET travelynx_status=excluded.travelynx_status, "
+            "patched_status=json_patch(excluded.travelynx_status, status_patch), network=NULL, "
             "from_time = excluded.from_time, from_station=excluded.from_station, from_lat=excluded.from_lat, from_lon=excluded.from_lon, "
             "to_time = excluded.to_time, to_station=excluded.to_station, to_lat=excluded.to_lat, to_lon=excluded.to_lon",
             (
                 zugid(status),
                 userid,
                 json.dumps(status),
+                json.dumps(status),
                 status["fromStation"]["realTime"],
                 status["fromStation"]["name"],
                 status["fromStation"]["latitude"],
@@ -366,41 +940,82 @@ class Trip:
                 status["toStation"]["longitude"],
             ),
         )
+        forget("trips", userid)
 
     def delete(self):
         DB.execute(
             "DELETE FROM trips WHERE user_id = ? AND journey_id = ?",
             (self.user_id, zugid(self.status)),
         )
+        DB.execute(
+            "DELETE FROM polylines WHERE user_id = ? AND journey_id = ?",
+            (self.user_id, zugid(self.status)),
+        )
+        forget("trips", self.user_id)
+
+    @classmethod
+    async def aupsert(cls, userid, status):
+        await write(cls.upsert, userid, status)
 
     def write_patch(self, status_patch):
         "write the status patch field to the database"
+        status_patch_json = json.dumps(status_patch)
         DB.execute(
-            "UPDATE trips SET status_patch=? WHERE user_id = ? AND journey_id = ?",
-            (json.dumps(status_patch), self.user_id, self.journey_id),
+            "UPDATE trips SET status_patch=?, patched_status=json_patch(travelynx_status, ?), network=NULL "
+            "WHERE user_id = ? AND journey_id = ?",
+            (status_patch_json, status_patch_json, self.user_id, self.journey_id),
         )
         self.status_patch = status_patch
+        forget("trips", self.user_id)
 
     def patch_patch(self, patch):
         "directly patch our status patch with a new patch"
-        self.write_patch(json_patch_dicts(patch, self.status_patch))
+        with DB.transaction():
+            if self.refresh():
+                self.write_patch(merge_patch(self.status_patch, patch, in_place=True))
+
+    async def awrite_patch(self, status_patch):
+        await write(self.write_patch, status_patch)
+
+    async def apatch_patch(self, patch):
+        await write(self.patch_patch, patch)
 
     def get_unpatched_status(self):
         """get the unpatched status, for mocking webhooks. this way we don't
         accidentally destructively commit the user's edits as the actual status."""
-        return json.loads(
+        return json.loads(self.unpatched_status)
+
+    def apply_hafas_data(self):
+        """fix up our status with what the hafas data tells us and store the network it's in.
+        doesn't write anything if all of that is still up to date. run this in a transaction"""
+        if not self.refresh():
+            return
+        fixed_1970 = self.maybe_fix_1970()
+        patched_sev = self.maybe_patch_sev()
+        # both reset the stored network when they write, load that and the fixed status
+        if (fixed_1970 or patched_sev) and not self.refresh():
+            return
+        network = get_network(self.status, self.hafas_data)
+        if network != self.network:
             DB.execute(
-                "SELECT travelynx_status FROM trips WHERE user_id = ? AND journey_id = ?",
-                (self.user_id, self.journey_id),
-            ).fetchone()["travelynx_status"]
-        )
+                "UPDATE trips SET network = ? WHERE user_id = ? AND journey_id = ?",
+                (network, self.user_id, self.journey_id),
+            )
+            self.network = network
+            forget("trips", self.user_id)
+
+    def get_network(self):
+        "the network for this version of the trip, worked out now if we haven't stored it yet"
+        if self.network is None:
+            self.network = get_network(self.status, self.hafas_data)
+        return self.network
 
     def maybe_fix_1970(self):
         """sometimes the toStation times wind up being unix time 0 instead of the actual time,
-        we can fix that. call only after fetch_hafas_data()"""
+        we can fix that. call only after fetch_hafas_data(). returns True if it did"""
 
         if self.status["toStation"]["realTime"] > 0:
-            return
+            return False
 
         if route := self.hafas_data.get("route"):
             for stop in route:
@@ -414,13 +1029,15 @@ class Trip:
                         stop["rt_arr"] or stop["sched_arr"]
                     )
                     self.upsert(self.user_id, self.status)
-                    return
+                    return True
+        return False
 
     def maybe_patch_sev(self):
-        "if we're reasonably sure we're on an replacement bus, add the SEV train type"
+        """if we're reasonably sure we're on an replacement bus, add the SEV train type.
+        returns True if we patched it"""
         train = self.status["train"]
         if not train["type"].casefold() in ("sev", "ev", "bus", "ersatzbus"):
-            return
+            return False
 
         if match := re.match(
             r"(?P<train_type>\b\w{1,4}) ?(?P<train_line>\d+\b)",
@@ -440,103 +1057,44 @@ class Trip:
                 ):
                     # Offenburg has Bus S1 and Bus R1 etc.
                     # what an edge case once again
-                    return
+                    return False
                 else:
-                    self.patch_patch(
-                        {
-                            "train": {
-                                "type": f"SEV|{match['train_type']}",
-                                "line": match["train_line"],
-                            }
+                    patch = {
+                        "train": {
+                            "type": f"SEV|{match['train_type']}",
+                            "line": match["train_line"],
                         }
-                    )
+                    }
+                    if merge_patch(self.status_patch, patch) != self.status_patch:
+                        self.patch_patch(patch)
+                        return True
+        return False
+
+    def save_hafas_data(self, data):
+        """store new hafas data and fix up our status with it. run this in a transaction,
+        so nobody sees the hafas data without the fixes"""
+        # polylines are big and only needed for the trip length, they get their own table
+        if polyline := data.pop("polyline", None):
+            Polyline.from_hafas(self.user_id, self.journey_id, polyline).write()
+        else:
+            Polyline.delete(self.user_id, self.journey_id)
+        self.hafas_data = data
+        DB.execute(
+            "UPDATE trips SET hafas_data=? WHERE user_id = ? AND journey_id = ?",
+            (
+                json.dumps(data),
+                self.user_id,
+                self.journey_id,
+            ),
+        )
+        forget("trips", self.user_id)
+        self.apply_hafas_data()
 
-    def fetch_hafas_data(self, force: bool = False):
+    async def fetch_hafas_data(self, force: bool = False):
         "perform arcane magick (perl 'FFI') to get hafas data for our trip"
 
-        def save_hafas_data(data):
-            self.hafas_data = data
-            DB.execute(
-                "UPDATE trips SET hafas_data=? WHERE user_id = ? AND journey_id = ?",
-                (
-                    json.dumps(data),
-                    self.user_id,
-                    self.journey_id,
-                ),
-            )
-
-        def get_stationboard(backend_name, station_id):
-            if backend_name == "ÖBB":
-                # wonky perl unicode handling that i do not understand
-                backend_name = bytes([214, 66, 66])
-            sb = subprocess.run(
-                [
-                    "json-hafas-stationboard.pl",
-                    backend_name,
-                    str(station_id),
-                    str(self.status["fromStation"]["scheduledTime"]),
-                ],
-                capture_output=True,
-            )
-            stationboard = {}
-            try:
-                stationboard = json.loads(sb.stdout)
-            except:  # pylint: disable=bare-except
-                print(
-                    f"{backend_name} stationboard perl broke:\n{sb.stdout} {sb.stderr}"
-                )
-                traceback.print_exc()
-                return None
-            if "error_code" in stationboard:
-                print(f"{backend_name} stationboard perl broke:\n{stationboard}")
-            return stationboard
-
-        def öbb_stopfinder():
-            hafas_stations = subprocess.run(
-                [
-                    "hafas-m",
-                    "-s",
-                    "ÖBB",
-                    f"?{self.status['fromStation']['name']}",
-                    "--json",
-                ],
-                capture_output=True,
-            )
-            stations = None
-            try:
-                stations = json.loads(hafas_stations.stdout)
-            except:  # pylint: disable=bare-except
-                print(
-                    f"alternative ÖBB station search perl broke:\n{hafas_stations.stdout} {hafas_stations.stderr}"
-                )
-                traceback.print_exc()
-                return
-            if not stations or "error_code" in stations:
-                print(f"alternative ÖBB station search broke:\n{stations}")
-                return
-            return stations[0]
-
-        def get_trip(backend_name, trip_id):
-            if backend_name == "ÖBB":
-                # wonky perl unicode handling that i do not understand
-                backend_name = bytes([214, 66, 66])
-
-            hafas = subprocess.run(
-                ["json-hafas.pl", backend_name, trip_id],
-                capture_output=True,
-            )
-            status = {}
-            try:
-                status = json.loads(hafas.stdout)
-                if "error_string" in status:
-                    print(f"{backend_name} trip perl broke:\n{status}")
-                    return None
-            except:  # pylint: disable=bare-except
-                print(f"{backend_name} trip perl broke:\n{hafas.stdout} {hafas.stderr}")
-                traceback.print_exc()
-                return None
-
-            return status
+        async def save_hafas_data(data):
+            await write_transaction(self.save_hafas_data, data)
 
         if ("id" in self.hafas_data or "failedhafas" in self.hafas_data) and not force:
             return
@@ -584,40 +1142,50 @@ class Trip:
             if not jid and "|" in self.status["train"]["id"]:
                 jid = self.status["train"]["id"]
 
-            stationboard = {}
+            stationboard = None
             if station_id == 0:
                 # skip guaranteed failed request and run stopfinder later
-                stationboard = {"error_string": "svcResL[0].err is LOCATION"}
+                stationboard = Stationboard(
+                    {"error_string": "svcResL[0].err is LOCATION"},
+                    self.status["fromStation"]["scheduledTime"],
+                )
             elif station_id > 0:
-                stationboard = get_stationboard(backend, station_id)
+                stationboard = await get_stationboard(
+                    backend,
+                    station_id,
+                    self.status["fromStation"]["scheduledTime"],
+                    force=force,
+                )
 
             if (
                 backend == "ÖBB"
-                and stationboard.get("error_string") == "svcResL[0].err is LOCATION"
+                and stationboard
+                and stationboard.error_string == "svcResL[0].err is LOCATION"
             ):
                 # if we got here via DBRIS/travelcrab mainline trains we might have run
                 # into a station that has a different ID in the ÖBB hafas
                 # run a stop finder request to try and find a stop with the same name
-                station = öbb_stopfinder()
-                if station.get("eva"):
+                eva = await oebb_stopfinder(self.status["fromStation"]["name"])
+                if eva:
                     print(
-                        f"trying to fix missing station {self.status['fromStation']}, found {station} instead"
+                        f"trying to fix missing station {self.status['fromStation']}, found {eva} instead"
+                    )
+                    stationboard = await get_stationboard(
+                        backend,
+                        eva,
+                        self.status["fromStation"]["scheduledTime"],
+                        force=force,
                     )
-                    stationboard = get_stationboard(backend, station["eva"])
                 else:
                     print(f"failed to fix missing station {self.status['fromStation']}")
 
-            if not stationboard or not "trains" in stationboard:
-                save_hafas_data({"failedhafas": True})
+            if not stationboard or not stationboard.trains:
+                await save_hafas_data({"failedhafas": True})
                 return
 
-            for train in stationboard["trains"]:
-                if (
-                    not train["scheduled"]
-                    == self.status["fromStation"]["scheduledTime"]
-                ):
-                    continue
-
+            for train in stationboard.departing_at(
+                self.status["fromStation"]["scheduledTime"]
+            ):
                 if (
                     jid == train["id"]
                     or (train["number"] == self.status["train"]["no"])
@@ -633,18 +1201,18 @@ class Trip:
                         )
                     )
                 ):
-                    trip = get_trip(backend, train["id"])
+                    trip = await get_trip(backend, train["id"])
                     if trip:
                         headsign = train["direction"]
                         if (not headsign) and (route := trip.get("route")):
                             headsign = route[-1]["name"]
 
                         trip.update(headsign=headsign, line=train["line"])
-                        save_hafas_data(trip)
+                        await save_hafas_data(trip)
                         return
             else:
                 print(f"did not find a match for {self.status['train']}!")
-                save_hafas_data({"failedhafas": True})
+                await save_hafas_data({"failedhafas": True})
                 return
 
         elif mode == "DBRIS":
@@ -654,19 +1222,20 @@ class Trip:
             if not jid and "|" in self.status["train"]["id"]:
                 jid = self.status["train"]["id"]
 
-            stationboard = get_stationboard("DBRIS", station_id)
+            stationboard = await get_stationboard(
+                "DBRIS",
+                station_id,
+                self.status["fromStation"]["scheduledTime"],
+                force=force,
+            )
 
-            if not stationboard or not "trains" in stationboard:
-                save_hafas_data({"failedhafas": True})
+            if not stationboard or not stationboard.trains:
+                await save_hafas_data({"failedhafas": True})
                 return
 
-            for train in stationboard["trains"]:
-                if (
-                    not train["scheduled"]
-                    == self.status["fromStation"]["scheduledTime"]
-                ):
-                    continue
-
+            for train in stationboard.departing_at(
+                self.status["fromStation"]["scheduledTime"]
+            ):
                 if (
                     jid == train["id"]
                     or (train["number"] == self.status["train"]["no"])
@@ -675,24 +1244,24 @@ class Trip:
                         == f"{self.status['train']['type']}{self.status['train']['line'] or self.status['train']['no']}"
                     )
                 ):
-                    save_hafas_data(
+                    await save_hafas_data(
                         {"headsign": train["direction"], "line": train["line"]}
                     )
                     return
             else:
                 print(f"did not find a match for {self.status['train']}!")
-                save_hafas_data({"failedhafas": True})
+                await save_hafas_data({"failedhafas": True})
                 return
         elif mode == "MOTIS":
             # 1. fetch train
             # 2. find current stop in route
             # 3. fetch stationboard, find train there and pick out correct headsign
-            trip = get_trip(
+            trip = await get_trip(
                 f"MOTIS-{backend}",
                 self.status["train"]["hafasId"] or self.status["train"]["id"],
             )
             if not trip:
-                save_hafas_data({"failedhafas": True})
+                await save_hafas_data({"failedhafas": True})
                 return
 
             station = None
@@ -704,23 +1273,28 @@ class Trip:
                     and s["sched_dep"] == self.status["fromStation"]["scheduledTime"]
                 ]
             ):
-                stationboard = get_stationboard(f"MOTIS-{backend}", stations[0]["eva"])
-                if stationboard and "trains" in stationboard:
+                stationboard = await get_stationboard(
+                    f"MOTIS-{backend}",
+                    stations[0]["eva"],
+                    self.status["fromStation"]["scheduledTime"],
+                    force=force,
+                )
+                if stationboard and stationboard.trains:
                     candidates = [
                         train
-                        for train in stationboard["trains"]
-                        if train["scheduled"]
-                        == self.status["fromStation"]["scheduledTime"]
-                        and train["id"]
+                        for train in stationboard.departing_at(
+                            self.status["fromStation"]["scheduledTime"]
+                        )
+                        if train["id"]
                         in (self.status["train"]["id"], self.status["train"]["hafasId"])
                     ]
                     if not candidates:
                         candidates = [
                             train
-                            for train in stationboard["trains"]
-                            if train["scheduled"]
-                            == self.status["fromStation"]["scheduledTime"]
-                            and train["line"] == self.status["train"]["line"]
+                            for train in stationboard.departing_at(
+                                self.status["fromStation"]["scheduledTime"]
+                            )
+                            if train["line"] == self.status["train"]["line"]
                         ]
                     if candidates:
                         headsign = candidates[0]["direction"]
@@ -736,53 +1310,50 @@ class Trip:
                             f"did not find a match at {stations[0]} for {self.status['train']}!"
                         )
 
-                    save_hafas_data(trip)
+                    await save_hafas_data(trip)
         elif mode == "EFA":
             # 1. fetch stationboard
             # 2. find train there, pick out ID, headsign and line
             # 3. fetch train
             jid = self.status["train"]["id"]
 
-            stationboard = get_stationboard(f"EFA-{backend}", station_id)
+            stationboard = await get_stationboard(
+                f"EFA-{backend}",
+                station_id,
+                self.status["fromStation"]["scheduledTime"],
+                force=force,
+            )
 
-            if not stationboard or not "trains" in stationboard:
-                save_hafas_data({"failedhafas": True})
+            if not stationboard or not stationboard.trains:
+                await save_hafas_data({"failedhafas": True})
                 return
 
-            for train in stationboard["trains"]:
-                # dear lord this is cursed
-                # compensate for subminute timestamps returned by efa
-                # vs minute accurate by travelynx
-                if (
-                    abs(
-                        train["scheduled"] - self.status["fromStation"]["scheduledTime"]
-                    )
-                    > 60
-                ):
-                    continue
-
+            # dear lord this is cursed
+            # compensate for subminute timestamps returned by efa
+            # vs minute accurate by travelynx
+            for train in stationboard.departing_around(
+                self.status["fromStation"]["scheduledTime"], 60
+            ):
                 # compensate for jid's changing during a trip(???)
                 if jid.split("@")[0] == train["id"].split("@")[0]:
-                    if trip := get_trip(f"EFA-{backend}", train["id"]):
+                    if trip := await get_trip(f"EFA-{backend}", train["id"]):
                         headsign = train["direction"]
                         if (not headsign) and (route := trip.get("route")):
                             headsign = route[-1]["name"]
 
                         trip.update(headsign=headsign, line=train["line"])
-                        save_hafas_data(trip)
+                        await save_hafas_data(trip)
                         return
             else:
                 print(f"did not find a match for {self.status['train']}!")
-                save_hafas_data({"failedhafas": True})
+                await save_hafas_data({"failedhafas": True})
                 return
         else:
             # manual trips and uhhhh EFA? not handled yet. later tm
             return
 
     def fetch_headsign(self):
-        if not self.hafas_data:
-            self.fetch_hafas_data()
-
+        "our headsign from the hafas data we already have, run fetch_hafas_data() for that first"
         if headsign := self.status["train"].get(
             "fakeheadsign", self.hafas_data.get("headsign")
         ):
@@ -798,7 +1369,83 @@ class Trip:
             )
         return "?"
 
-    def get_db_composition(self):
+    async def fetch_composition(self):
+        """ask every composition provider that applies to this trip at the same time. the first
+        composition we get wins and the others get cancelled, then whatever we found out
+        (including which providers failed) is written in one patch."""
+        if "composition" in self.status:
+            return
+
+
+        async def ask(provider):
+            """the provider's result, or None if it broke. that includes running into its
+            own timeout, only composition_timeout for all of them ends the search"""
+            try:
+                return await provider()
+            except Exception:  # pylint: disable=broad-exception-caught
+                print(f"composition provider {provider.__name__} broke")
+                traceback.print_exc()
+                return None
+
+        providers = [
+            asyncio.ensure_future(ask(provider))
+            for provider in (
+                self.get_oebb_composition,
+                self.get_db_composition,
+                self.get_ns_composition,
+                self.get_vagonweb_composition,
+                self.get_rtt_composition,
+            )
+        ]
+        results = []
+        try:
+            for provider in asyncio.as_completed(
+                providers, timeout=config.get("composition_timeout", 20)
+            ):
+                if result := await provider:
+                    results.append(result)
+                    if "composition" in result.patch:
+                        break
+        except asyncio.TimeoutError:
+            print(f"composition providers for {self.journey_id} timed out")
+        finally:
+            for provider in providers:
+                provider.cancel()
+
+        if results:
+            await write_transaction(self.save_composition, results)
+
+    def save_composition(self, results):
+        """write what the composition providers found out, merged in the order we got it:
+        short links for the compositions' pages, train names and the patch. run this in a
+        transaction, so all of that is one enrichment write"""
+        if not self.refresh():
+            return
+        links = {}
+        if urls := [result.link for result in results if result.link]:
+            links = Link.make_all(urls)
+        patch = {}
+        for result in results:
+            if result.link:
+                result.patch["composition"] = (
+                    f"[{result.patch['composition']}]"
+                    f"({config['shortener_url']}/{links[result.link].short_id})"
+                )
+            patch = json_patch_dicts(result.patch, patch)
+        if train_names := [result.train_name for result in results if result.train_name]:
+            self.hafas_data.setdefault("messages", []).extend(
+                {"code": "ZN", "short": None, "text": train_name, "type": "I"}
+                for train_name in train_names
+            )
+            DB.execute(
+                "UPDATE trips SET hafas_data=? WHERE user_id = ? AND journey_id = ?",
+                (json.dumps(self.hafas_data), self.user_id, self.journey_id),
+            )
+            forget("trips", self.user_id)
+        if patch:
+            self.write_patch(merge_patch(self.status_patch, patch, in_place=True))
+
+    async def get_db_composition(self):
         if "composition" in self.status or "failedcomposition-db" in self.status:
             return
 
@@ -809,30 +1456,29 @@ class Trip:
         ):
             return
 
-        db_wr = subprocess.run(
-            [
-                "json-db-composition.pl",
-                str(self.status["fromStation"]["scheduledTime"]),
-                str(self.status["fromStation"]["uic"]),
-                self.status["train"]["type"],
-                self.status["train"]["no"],
-            ],
-            capture_output=True,
+        db_wr = await perl_workers.request(
+            "json-db-composition.pl",
+            self.status["fromStation"]["scheduledTime"],
+            self.status["fromStation"]["uic"],
+            self.status["train"]["type"],
+            self.status["train"]["no"],
         )
+        if db_wr is None:
+            return None
         status = {}
         try:
-            status = json.loads(db_wr.stdout)
+            status = json.loads(db_wr)
         except:  # pylint: disable=bare-except
-            print(f"db_wr perl broke:\n{db_wr.stdout} {db_wr.stderr}")
+            print(f"db_wr perl broke:\n{db_wr}")
             traceback.print_exc()
 
         if status.get("error_string") == "404 Not Found":
-            self.patch_patch({"failedcomposition-db": True})
-            return
+            return CompositionResult({"failedcomposition-db": True})
         elif "error_string" in status:
             print(f"db_wr perl broke:\n{status}")
-            return
+            return None
 
+        result = None
         composition = []
         for group in status["groups"]:
             wagons = group["carriages"]
@@ -906,16 +1552,13 @@ class Trip:
                 .astimezone(timezone.utc)
                 .replace(tzinfo=None)
             )
-            link = Link.make(
-                f"https://dbf.finalrewind.org/carriage-formation?tn={self.status['train']['no']}"
+            result = CompositionResult(
+                {"composition": composition_text},
+                link=f"https://dbf.finalrewind.org/carriage-formation?tn={self.status['train']['no']}"
                 f"&tt={self.status['train']['type']}&eva={self.status['fromStation']['uic']}"
-                f"&dt={int(departure.timestamp())}"
-            )
-            self.patch_patch(
-                {
-                    "composition": f"[{composition_text}]({config['shortener_url']}/{link.short_id})"
-                }
+                f"&dt={int(departure.timestamp())}",
             )
+        return result
 
     async def get_rtt_composition(self):
         if "composition" in self.status or "failedcomposition-rtt" in self.status:
@@ -928,39 +1571,39 @@ class Trip:
 
         now = datetime.now(tz=User.find(discord_id=self.user_id).get_timezone())
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    "https://www.realtimetrains.co.uk/service/gb-nr:"
-                    f"{self.status['train']['line']}/{now:%Y-%m-%d}/detailed"
-                ) as response:
-                    apply_patch = {"network": "UK"}
-                    soup = BeautifulSoup(await response.text(), "html.parser")
-                    try:
-                        plan_nodes = soup.select_one("div.allocation").getText().strip()
-                        plan_nodes = re_british_class_numbers.sub(r"\1 \2", plan_nodes)
-                        plan_nodes = plan_nodes.split("+")
-                        plan_nodes = " + ".join(
-                            format_composition_element(node) for node in plan_nodes
-                        )
-                        apply_patch["composition"] = plan_nodes
-                    except:
-                        print("rtt: no nodes found")
-                        traceback.print_exc()
-                        apply_patch["failedcomposition-rtt"] = True
-                    operatorheader = soup.select_one("#servicetitle .header")
-                    destination_text = " ".join(operatorheader.stripped_strings)
-                    if "to" in destination_text:
-                        destination = destination_text.split("to")[-1].strip()
-                        apply_patch["train"] = {"fakeheadsign": destination}
-                    apply_patch["operator"] = soup.select_one(
-                        "#servicetitle .toc > div"
-                    ).getText()
-                    self.patch_patch(apply_patch)
+            async with get_session().get(
+                "https://www.realtimetrains.co.uk/service/gb-nr:"
+                f"{self.status['train']['line']}/{now:%Y-%m-%d}/detailed"
+            ) as response:
+                apply_patch = {"network": "UK"}
+                soup = BeautifulSoup(await response.text(), "html.parser")
+                try:
+                    plan_nodes = soup.select_one("div.allocation").getText().strip()
+                    plan_nodes = re_british_class_numbers.sub(r"\1 \2", plan_nodes)
+                    plan_nodes = plan_nodes.split("+")
+                    plan_nodes = " + ".join(
+                        format_composition_element(node) for node in plan_nodes
+                    )
+                    apply_patch["composition"] = plan_nodes
+                except:
+                    print("rtt: no nodes found")
+                    traceback.print_exc()
+                    apply_patch["failedcomposition-rtt"] = True
+                operatorheader = soup.select_one("#servicetitle .header")
+                destination_text = " ".join(operatorheader.stripped_strings)
+                if "to" in destination_text:
+                    destination = destination_text.split("to")[-1].strip()
+                    apply_patch["train"] = {"fakeheadsign": destination}
+                apply_patch["operator"] = soup.select_one(
+                    "#servicetitle .toc > div"
+                ).getText()
+                return CompositionResult(apply_patch)
+        except asyncio.CancelledError:
+            raise
         except:
             print(f"rtt request broke")
             traceback.print_exc()
-            self.patch_patch({"failedcomposition-rtt": True})
-            return
+            return CompositionResult({"failedcomposition-rtt": True})
 
     async def get_vagonweb_composition(self):
         if "composition" in self.status or "failedcomposition-vagonweb" in self.status:
@@ -1014,15 +1657,15 @@ class Trip:
         }
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    soup = BeautifulSoup(await response.text(), "html.parser")
+            async with get_session().get(url, headers=headers) as response:
+                soup = BeautifulSoup(await response.text(), "html.parser")
             plan_nodes = soup.select("#planovane_razeni table")
+        except asyncio.CancelledError:
+            raise
         except:
             print(f"vagonweb request broke")
             traceback.print_exc()
-            self.patch_patch({"failedcomposition-vagonweb": True})
-            return
+            return CompositionResult({"failedcomposition-vagonweb": True})
         if plan_nodes:
             try:
                 zugname = None
@@ -1060,35 +1703,14 @@ class Trip:
                     composition_text = " + ".join(
                         [format_composition_element(unit) for unit in composition]
                     )
-                link = Link.make(url)
-                self.patch_patch(
-                    {
-                        "composition": f"[{composition_text}]({config['shortener_url']}/{link.short_id})"
-                    }
+                return CompositionResult(
+                    {"composition": composition_text}, link=url, train_name=zugname
                 )
-                if zugname:
-                    if "messages" not in self.hafas_data:
-                        self.hafas_data["messages"] = []
-                    self.hafas_data["messages"].append(
-                        {
-                            "code": "ZN",
-                            "short": None,
-                            "text": zugname,
-                            "type": "I",
-                        }
-                    )
-                    DB.execute(
-                        "UPDATE trips SET hafas_data=? WHERE user_id = ? AND journey_id = ?",
-                        (
-                            json.dumps(self.hafas_data),
-                            self.user_id,
-                            self.journey_id,
-                        ),
-                    )
             except:
                 print("vagonweb parsing went wrong")
                 traceback.print_exc()
-                self.patch_patch({"failedcomposition-vagonweb": True})
+                return CompositionResult({"failedcomposition-vagonweb": True})
+        return None
 
     async def get_oebb_composition(self):
         if "composition" in self.status:
@@ -1134,16 +1756,13 @@ class Trip:
             departure = datetime.fromtimestamp(
                 self.status["fromStation"]["scheduledTime"], tz=tz
             )
-            link = Link.make(
-                f"https://live.oebb.at/train-info?trainNr={self.status['train']['no']}"
+            return CompositionResult(
+                {"composition": composition_text},
+                link=f"https://live.oebb.at/train-info?trainNr={self.status['train']['no']}"
                 f"&date={departure:%Y-%m-%d}&station={self.status['fromStation']['uic']}"
-                f"&time={departure:%H%%3A%M}"
-            )
-            self.patch_patch(
-                {
-                    "composition": f"[{composition_text}]({config['shortener_url']}/{link.short_id})"
-                }
+                f"&time={departure:%H%%3A%M}",
             )
+        return None
 
     async def get_ns_composition(self):
         if "composition" in self.status or "failedcomposition-ns" in self.status:
@@ -1154,25 +1773,132 @@ class Trip:
             return
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    "https://vt.ns-mlab.nl/api/v1/trein?ids="
-                    f"{self.status['train']['no']}"
-                ) as response:
-                    parsed = await response.json()
-                    material = parsed[0]["materieeldelen"]
-                    composition_text = " + ".join(
-                        [
-                            f"**{deel['type'] or 'Trein'}** {deel.get('materieelnummer') or ''}"
-                            for deel in material
-                        ]
-                    )
-                    self.patch_patch({"composition": composition_text})
+            async with get_session().get(
+                "https://vt.ns-mlab.nl/api/v1/trein?ids="
+                f"{self.status['train']['no']}"
+            ) as response:
+                parsed = await response.json()
+                material = parsed[0]["materieeldelen"]
+                composition_text = " + ".join(
+                    [
+                        f"**{deel['type'] or 'Trein'}** {deel.get('materieelnummer') or ''}"
+                        for deel in material
+                    ]
+                )
+                return CompositionResult({"composition": composition_text})
+        except asyncio.CancelledError:
+            raise
         except:
             print(f"ns request broke")
             traceback.print_exc()
-            self.patch_patch({"failedcomposition-ns": True})
-            return
+            return CompositionResult({"failedcomposition-ns": True})
+
+
+@dataclass
+class Polyline:
+    "a trip's polyline, with the distance along it from the first point precomputed"
+    journey_id: str
+    user_id: int
+    points: bytes
+    distances: bytes
+    stops: str
+
+    def __post_init__(self):
+        self.distances = array.array("d", self.distances)
+        # first index of a point with that eva or name. points that aren't stops
+        # have neither, so they count as None for both
+        self.first_eva = {}
+        self.first_name = {}
+        stop_indices = set()
+        for index, eva, name in json.loads(self.stops):
+            self.first_eva.setdefault(eva, index)
+            self.first_name.setdefault(name, index)
+            stop_indices.add(index)
+        first_non_stop = next(
+            (i for i in range(len(self.distances)) if not i in stop_indices), None
+        )
+        if first_non_stop is not None:
+            for first in (self.first_eva, self.first_name):
+                first[None] = min(first.get(None, first_non_stop), first_non_stop)
+
+    @classmethod
+    def from_hafas(cls, user_id, journey_id, polyline):
+        points = array.array("f")
+        distances = array.array("d")
+        stops = []
+        distance = 0
+        for i, point in enumerate(polyline):
+            if i:
+                distance += haversine(
+                    (polyline[i - 1]["lat"], polyline[i - 1]["lon"]),
+                    (point["lat"], point["lon"]),
+                )
+            points.extend((point["lat"], point["lon"]))
+            distances.append(distance)
+            if point["eva"] is not None or point["name"] is not None:
+                stops.append([i, point["eva"], point["name"]])
+        return cls(
+            journey_id,
+            user_id,
+            points.tobytes(),
+            distances.tobytes(),
+            json.dumps(stops),
+        )
+
+    @classmethod
+    def find(cls, user_id, journey_id):
+        row = DB.execute(
+            "SELECT * FROM polylines WHERE user_id = ? AND journey_id = ?",
+            (user_id, journey_id),
+        ).fetchone()
+        if row:
+            return cls(**row)
+        return None
+
+    @classmethod
+    def find_all(cls, user_id, journey_ids):
+        "journey id -> polyline for those of journey_ids that have one"
+        rows = DB.execute(
+            "SELECT * FROM polylines WHERE user_id = ? AND journey_id IN "
+            f"({','.join('?' * len(journey_ids))})",
+            (user_id, *journey_ids),
+        ).fetchall()
+        return {row["journey_id"]: cls(**row) for row in rows}
+
+    def write(self):
+        DB.execute(
+            "INSERT OR REPLACE INTO polylines(journey_id, user_id, points, distances, stops) "
+            "VALUES(?,?,?,?,?)",
+            (
+                self.journey_id,
+                self.user_id,
+                self.points,
+                self.distances.tobytes(),
+                self.stops,
+            ),
+        )
+
+    @staticmethod
+    def delete(user_id, journey_id):
+        DB.execute(
+            "DELETE FROM polylines WHERE user_id = ? AND journey_id = ?",
+            (user_id, journey_id),
+        )
+
+    def first_match(self, station):
+        return min(
+            self.first_eva.get(station["uic"], len(self.distances)),
+            self.first_name.get(station["name"], len(self.distances)),
+        )
+
+    def length(self, from_station, to_station):
+        """km along the polyline from the first point that is from_station to the first
+        point that is to_station after it, or the end of the line if there's none"""
+        start = self.first_match(from_station)
+        end = min(self.first_match(to_station), len(self.distances) - 1)
+        if start >= end:
+            return 0
+        return self.distances[end] - self.distances[start]
 
 
 @dataclass
@@ -1189,7 +1915,9 @@ class Message:
 
     async def delete(self, bot):
         await (await self.fetch(bot)).delete()
-        DB.execute("DELETE FROM messages WHERE message_id = ?", (self.message_id,))
+        await write(
+            DB.execute, "DELETE FROM messages WHERE message_id = ?", (self.message_id,)
+        )
 
     @classmethod
     def find_all(cls, user_id, journey_id):
@@ -1254,6 +1982,19 @@ class Link:
             (self.short_id, self.long_url),
         )
 
+    @classmethod
+    def make_all(cls, long_urls):
+        "long url -> link for all of long_urls, looking up the ones we already have at once"
+        rows = DB.execute(
+            f"SELECT * FROM links WHERE long_url IN ({','.join('?' * len(long_urls))})",
+            tuple(long_urls),
+        ).fetchall()
+        links = {row["long_url"]: cls(**row) for row in rows}
+        for long_url in long_urls:
+            if not long_url in links:
+                links[long_url] = cls.make(long_url)
+        return links
+
     @classmethod
     def make(cls, long_url: str):
         if exists := cls.find_by_long(long_url):
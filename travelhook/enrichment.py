@@ -0,0 +1,114 @@
+"fill in what we know about trips in the background, without holding up the live feed"
+import asyncio
+import collections
+import contextvars
+import random
+import time
+import traceback
+
+from . import database as DB
+from .helpers import config
+
+
+class RetryScheduler:
+    """retries fetch_hafas_data for trips where it failed. retries back off exponentially
+    with jitter so a backend outage doesn't end in everyone refetching at the same time,
+    only a few run at once and there's a budget of retries per hour across all trips.
+    on_success gets called with the trip once we finally have hafas data for it."""
+
+    def __init__(self, on_success):
+        self.on_success = on_success
+        self.pending = {}
+        self.semaphore = asyncio.Semaphore(config.get("hafas_retry_concurrency", 2))
+        self.attempts = config.get("hafas_retry_attempts", 6)
+        self.base_delay = config.get("hafas_retry_delay", 60)
+        self.budget = config.get("hafas_retry_budget", 120)
+        self.spent = collections.deque()
+
+    def schedule(self, trip):
+        key = (trip.user_id, trip.journey_id)
+        if key not in self.pending:
+            # retries outlive the webhook or interaction that scheduled them by hours, they
+            # mustn't keep its unit of work around and add to it
+            self.pending[key] = asyncio.create_task(
+                self.retry(*key), context=contextvars.Context()
+            )
+
+    def take_from_budget(self):
+        now = time.monotonic()
+        while self.spent and self.spent[0] < now - 3600:
+            self.spent.popleft()
+        if len(self.spent) >= self.budget:
+            return False
+        self.spent.append(now)
+        return True
+
+    async def retry(self, user_id, journey_id):
+        try:
+            for attempt in range(self.attempts):
+                delay = self.base_delay * 2**attempt
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+
+                # the trip might be gone or updated by someone pressing the button by now
+                trip = await DB.Trip.afind(user_id, journey_id)
+                if not trip or not "failedhafas" in trip.hafas_data:
+                    return
+                if not self.take_from_budget():
+                    print(f"out of hafas retry budget, skipping {journey_id}")
+                    continue
+
+                async with self.semaphore:
+                    await trip.fetch_hafas_data(force=True)
+                if not "failedhafas" in trip.hafas_data:
+                    print(f"got hafas data for {journey_id} on retry {attempt + 1}")
+                    await self.on_success(trip)
+                    return
+
+            print(f"giving up on hafas data for {journey_id}")
+        except:  # pylint: disable=bare-except
+            print(f"retrying hafas data for {journey_id} broke")
+            traceback.print_exc()
+        finally:
+            del self.pending[(user_id, journey_id)]
+
+
+class EnrichmentQueue:
+    """runs jobs in the background on a fixed number of workers. jobs for the same user run
+    one after another in the order they were put in, jobs for different users in parallel."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.tasks = []
+        # user id -> jobs not done yet. a user is in here while a worker is on their jobs
+        # or they're waiting in ready for one to become free
+        self.jobs = {}
+        self.ready = asyncio.Queue()
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self.work(), context=contextvars.Context())
+            for _ in range(self.workers)
+        ]
+
+    def put(self, user_id, job):
+        "job is called without arguments and awaited once it's this user's turn"
+        if user_id in self.jobs:
+            self.jobs[user_id].append(job)
+        else:
+            self.jobs[user_id] = collections.deque([job])
+            self.ready.put_nowait(user_id)
+
+    async def work(self):
+        while True:
+            user_id = await self.ready.get()
+            jobs = self.jobs[user_id]
+            while jobs:
+                try:
+                    await jobs[0]()
+                except asyncio.CancelledError:
+                    raise
+                except:  # pylint: disable=bare-except
+                    print(f"enrichment job for {user_id} broke")
+                    traceback.print_exc()
+                jobs.popleft()
+            del self.jobs[user_id]
@@ -1,11 +1,17 @@
 "this module, or rather its function format_travelynx, renders nice embed describing the current journey"
 
+import collections
+from dataclasses import dataclass
 from itertools import groupby
+import hashlib
 import json
+import math
 from datetime import datetime, timedelta
 import random
 import re
+from typing import Optional
 import urllib
+from zoneinfo import ZoneInfo
 
 import discord
 import tomli
@@ -16,7 +22,7 @@ from .helpers import (
     config,
     format_delta,
     format_time,
-    generate_train_link,
+    train_link_url,
     LineEmoji,
     trip_length,
     random_id,
@@ -24,6 +30,7 @@ from .helpers import (
     decline_operator_with_article,
     zugid,
     format_timezone,
+    LRUCache,
 )
 
 re_remove_vienna_suffixes = re.compile(r"(?P<name>Wien .+) \(.+\)")
@@ -85,148 +92,211 @@ british_tocs = {
 }
 train_types_config = {}
 with open("train_types.toml", "rb") as f:
-    train_types_config = tomli.load(f)
-
-emoji_cache = {}
-
-
-def get_network(status):
-    if "network" in status:
-        return status["network"]
-
-    hafas_data = DB.DB.execute(
-        "SELECT hafas_data FROM trips WHERE journey_id = ? AND hafas_data != '{}'",
-        (zugid(status),),
-    ).fetchone()
-    if hafas_data:
-        hafas_data = json.loads(hafas_data["hafas_data"])
-    else:
-        hafas_data = {}
-
-    operator = status.get("operator", hafas_data.get("operator")) or ""
-
-    lat = status["fromStation"]["latitude"]
-    lon = status["fromStation"]["longitude"]
-
-    # network NS: Nederlandse Spoorwegen trains
-    if operator == "Nederlandse Spoorwegen":
-        return "NS"
-
-    # network KVV: Stadtbahn Karlsruhe
-    if operator in (
-        "Albtal-Verkehrs-Gesellschaft mbH",
-        "Albtal-Verkehrs-Gesellschaft",
-        "Tram VBK",
-        "Verkehrsbetriebe Karlsruhe GmbH",
-    ) or (
-        status["train"]["type"] in ("STR", "TRAM")
-        and haversine((lat, lon), (49.009, 8.417)) < 15
-    ):
-        return "KVV"
-
-    # network RNV: trams in mannheim, ludwigshafen and heidelberg
-    if (
-        operator.startswith("Rhein-Neckar-Verkehr")
-        or operator.startswith("RNV")
-        or (
-            (status["train"]["type"] in ("", "STR", "RNV", "TRAM"))
-            and haversine((lat, lon), (49.47884, 8.55787)) < 29
+    train_types_bytes = f.read()
+    train_types_config = tomli.loads(train_types_bytes.decode())
+# goes into every trip's etag, so rendered trips don't outlive a change to train_types.toml
+train_types_version = hashlib.blake2b(train_types_bytes, digest_size=16).digest()
+
+
+class TrainTypeIndex:
+    """train_types compiled for looking up the entry that applies to a train. gives the same
+    answer as going through the list and taking the first entry that matches, but only
+    looks at the entries that could match by type, network and line."""
+
+    def __init__(self, train_types):
+        # (type, network) -> entries that need exactly these, None where they take anything
+        self.buckets = {}
+        for order, tt in enumerate(train_types):
+            key = (
+                tt["type"].casefold() if "type" in tt else None,
+                tt["network"].casefold() if "network" in tt else None,
+            )
+            bucket = self.buckets.setdefault(key, {"line": {}, "trie": {}, "any": None})
+            if "line" in tt:
+                bucket["line"].setdefault(tt["line"], []).append((order, tt))
+            elif "line_startswith" in tt:
+                node = bucket["trie"]
+                for char in tt["line_startswith"]:
+                    node = node.setdefault(char, {})
+                # None marks an entry whose prefix ends here, the first one wins
+                node.setdefault(None, (order, tt))
+            elif not bucket["any"]:
+                bucket["any"] = (order, tt)
+
+    @staticmethod
+    def candidates(bucket, line):
+        "the first entry in bucket matching line from each of its lookups"
+        for order, tt in bucket["line"].get(line, ()):
+            if not "line_startswith" in tt or (
+                line and line.startswith(tt["line_startswith"])
+            ):
+                yield order, tt
+                break
+        if line:
+            node = bucket["trie"]
+            for char in (None, *line):
+                if char is not None and not (node := node.get(char)):
+                    break
+                if None in node:
+                    yield node[None]
+        if bucket["any"]:
+            yield bucket["any"]
+
+    def match(self, type, line, network):
+        type = type.casefold()
+        network = network.casefold()
+        best = None
+        for key in ((type, network), (type, None), (None, network), (None, None)):
+            if bucket := self.buckets.get(key):
+                for candidate in self.candidates(bucket, line):
+                    if not best or candidate[0] < best[0]:
+                        best = candidate
+        return best[1] if best else None
+
+
+class NetworkRule:
+    "one entry of networks in train_types.toml"
+
+    def __init__(self, rule):
+        self.network = rule["network"]
+        self.circle = rule.get("circle")
+        self.box = rule.get("box")
+        self.types = set(rule["types"]) if "types" in rule else None
+        self.types_casefold = (
+            set(rule["types_casefold"]) if "types_casefold" in rule else None
         )
-    ):
-        return "RNV"
 
-    # network WL: U-Bahn Wien
-    if operator.startswith("Wiener Linien"):
-        return "WL"
-
-    if "regiobahn" in operator.casefold():
-        return "REGIOBAHN"
-
-    # network SWien: S-Bahn Wien
-    if haversine((lat, lon), (48.21, 16.39)) < 70:
-        return "SWien"
-
-    # network AT: austrian trains
-    if (
-        8100000 < status["fromStation"]["uic"] < 8200000
-        or 8100000 < status["toStation"]["uic"] < 8200000
-    ):
-        return "AT"
-
-    # network DPP: Praha metro
-    if haversine((lat, lon), (50.08, 14.42)) < 12:
-        return "DPP"
-
-    # network BKV: Budapest metro
-    if haversine((lat, lon), (47.49, 19.04)) < 10:
-        return "BKV"
-
-    # network Ü: Stadtbahn Hannover
-    if (
-        status["train"]["type"].casefold().strip() in ("str", "stb")
-        and haversine((lat, lon), (52.369, 9.740)) < 20
-    ):
-        return "Ü"
-
-    # network KVB: Stadtbahn Köln/Bonn
-    if (50.62 < lat < 51.04) and (6.72 < lon < 7.26):
-        return "KVB"
+    def bounds(self):
+        "lat_min, lat_max, lon_min, lon_max of our region, a bit more for circles"
+        if self.box:
+            return self.box
+        if self.circle:
+            lat, lon, km = self.circle
+            # a degree of latitude is a bit more than 111 km, so this errs on the large side
+            dlat = km / 110
+            dlon = km / (110 * math.cos(math.radians(min(abs(lat) + dlat, 89))))
+            return (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+        return None
 
-    # network BVG: U-Bahn Berlin
-    if haversine((lat, lon), (52.52, 13.41)) < 30:
-        return "BVG"
+    def in_region(self, status):
+        train_type = status["train"]["type"]
+        if self.types is not None and not train_type in self.types:
+            return False
+        if (
+            self.types_casefold is not None
+            and not train_type.casefold().strip() in self.types_casefold
+        ):
+            return False
+        lat = status["fromStation"]["latitude"]
+        lon = status["fromStation"]["longitude"]
+        if self.box:
+            lat_min, lat_max, lon_min, lon_max = self.box
+            return lat_min < lat < lat_max and lon_min < lon < lon_max
+        return haversine((lat, lon), (self.circle[0], self.circle[1])) < self.circle[2]
+
+
+class NetworkIndex:
+    """networks in train_types.toml, compiled so a lookup doesn't have to try every single
+    one. operators are looked up once and remembered, regions are put on a grid so we only
+    check the ones touching the grid cell we're in. the first network in the file that
+    matches still wins."""
+
+    cell_size = 0.5
+
+    def __init__(self, rules):
+        self.rules = [NetworkRule(rule) for rule in rules]
+        self.operators = {}
+        self.operator_startswith = []
+        self.operator_contains = []
+        self.uic_between = []
+        cells = collections.defaultdict(list)
+        for i, (rule, region) in enumerate(zip(rules, self.rules)):
+            for operator in rule.get("operator", ()):
+                self.operators.setdefault(operator, i)
+            for prefix in rule.get("operator_startswith", ()):
+                self.operator_startswith.append((i, prefix))
+            for part in rule.get("operator_contains", ()):
+                self.operator_contains.append((i, part))
+            if "uic_between" in rule:
+                self.uic_between.append((i, *rule["uic_between"]))
+            if bounds := region.bounds():
+                lat_min, lat_max, lon_min, lon_max = (
+                    math.floor(b / self.cell_size) for b in bounds
+                )
+                for lat in range(lat_min, lat_max + 1):
+                    for lon in range(lon_min, lon_max + 1):
+                        cells[(lat, lon)].append(i)
+        self.cells = {cell: tuple(indices) for cell, indices in cells.items()}
+        self.operator_cache = {}
+
+    def find_operator(self, operator):
+        "index of the first rule that matches by operator, len(rules) if none does"
+        if (found := self.operator_cache.get(operator)) is not None:
+            return found
+        found = min(
+            [
+                self.operators.get(operator, len(self.rules)),
+                *(i for i, p in self.operator_startswith if operator.startswith(p)),
+                *(i for i, p in self.operator_contains if p in operator.casefold()),
+            ]
+        )
+        self.operator_cache[operator] = found
+        return found
+
+    def find(self, status, operator):
+        "the first network status matches, or None"
+        best = self.find_operator(operator)
+        for i, low, high in self.uic_between:
+            if i >= best:
+                break
+            if any(
+                low < (status[station]["uic"] or 0) < high
+                for station in ("fromStation", "toStation")
+            ):
+                best = i
+                break
+        cell = (
+            math.floor(status["fromStation"]["latitude"] / self.cell_size),
+            math.floor(status["fromStation"]["longitude"] / self.cell_size),
+        )
+        for i in self.cells.get(cell, ()):
+            if i >= best:
+                break
+            if self.rules[i].in_region(status):
+                best = i
+                break
+        if best < len(self.rules):
+            return self.rules[best].network
+        return None
 
-    # network HHA: U-Bahn Hamburg
-    if haversine((lat, lon), (53.54, 10.01)) < 30:
-        return "HHA"
 
-    # network MVG: U-Bahn München
-    if haversine((lat, lon), (48.15, 11.54)) < 30:
-        return "MVG"
+train_type_index = TrainTypeIndex(train_types_config["train_types"])
+network_index = NetworkIndex(train_types_config["networks"])
+all_types = {
+    tt["type"].casefold() for tt in train_types_config["train_types"] if "type" in tt
+}
 
-    # network NRW: Stadtbahn Rhein/Ruhr
-    if (51.06 < lat < 51.68) and (6.46 < lon < 7.77):
-        return "NRW"
+emoji_cache = {}
 
-    # network VAG: U-Bahn Nürnberg
-    if haversine((lat, lon), (49.45, 11.05)) < 10:
-        return "VAG"
 
-    # network VGF: Stadtbahn Frankfurt
-    if haversine((lat, lon), (50.11, 8.68)) < 30:
-        return "VGF"
+def get_network(status, hafas_data=None):
+    """figure out which transit network a train runs in. this isn't cheap, for trips we
+    know use their get_network() instead, which only does it once per version of the trip"""
+    if "network" in status:
+        return status["network"]
 
-    # network SAAR: Saarbahn
-    if haversine((lat, lon), (49.25, 6.98)) < 19 and status["train"]["type"] in (
-        "STR",
-        "STB",
-    ):
-        return "SAAR"
-
-    # network ST: third-party operators in the netherlands
-    if operator in ("Blauwnet", "Arriva Nederland", "RRReis", "R-net"):
-        return "ST"
-
-    if operator in (
-        "Schweizerische Bundesbahnen",
-        "Schweizerische Bundesbahnen SBB",
-        "Schweizerische Südostbahn (sob)",
-        "BLS AG",
-        "BLS AG (bls)",
-    ):
-        return "CH-FV"
-
-    if operator in (
-        "Transport publics de la Région Lausannoise",
-        "Transports Publics de la Région Lausannoise sa",
-    ) or (
-        haversine((lat, lon), (46.52, 6.63)) < 6
-        and status["train"]["type"] in ("U", "M")
-    ):
-        return "tl"
+    if hafas_data is None:
+        if row := DB.DB.execute(
+            "SELECT hafas_data FROM trips WHERE journey_id = ? AND hafas_data != '{}'",
+            (zugid(status),),
+        ).fetchone():
+            hafas_data = json.loads(row["hafas_data"])
+        else:
+            hafas_data = {}
 
-    if operator == "CTS":
-        return "CTS"
+    operator = status.get("operator", hafas_data.get("operator")) or ""
+    if network := network_index.find(status, operator):
+        return network
 
     trainplusline = (
         f"{status['train']['type']} {status['train']['line']}".removeprefix("SUBWAY")
@@ -251,28 +321,23 @@ def get_network(status):
     return ""
 
 
-def get_display(bot, status):
+def get_display(bot, status, network):
     ret = {}
-    all_types = [
-        t.get("type").casefold()
-        for t in train_types_config["train_types"]
-        if "type" in t
-    ]
     for type in status["train"]["type"].strip().split("|"):
         line = status["train"]["line"]
 
         type = blanket_replace_train_type.get(type, type)
 
-        if get_network(status) == "DPP":
+        if network == "DPP":
             if not type and line in ("A", "B", "C"):
                 type = "U"
 
-        if get_network(status) == "BKV":
+        if network == "BKV":
             if not type and line in ("M1", "M2", "M3", "M4"):
                 type = "M"
                 line = line[1:]
 
-        if get_network(status) == "UK":
+        if network == "UK":
             trainplusline = (
                 f"{status['train']['type']} {status['train']['line']}".removeprefix(
                     "SUBWAY"
@@ -308,12 +373,12 @@ def get_display(bot, status):
         if type == "RT":
             type = "STR"
             line = "RT" + line
-        if type == "Bus" and get_network(status) == "WL":
+        if type == "Bus" and network == "WL":
             line = line.replace("A", "ᴀ").replace("B", "ʙ")
         if type == "ICB":
             type = "coach"
             line = "Intercitybus"
-        if get_network(status) == "RNV":
+        if network == "RNV":
             if not type:
                 type = "STR"
             line = line.removeprefix("RNV ")
@@ -327,52 +392,37 @@ def get_display(bot, status):
                 type = "S"
                 line = f"N{line}"
 
-        if get_network(status) == "REGIOBAHN" and line.startswith("S"):
+        if network == "REGIOBAHN" and line.startswith("S"):
             type = "S"
 
         if status["backend"]["type"] == "MOTIS":
             motis_train_types = {"TRAM": "STR"}
             type = motis_train_types.get(type, type)
 
-        if get_network(status) == "KVB" and type == "SUBWAY":
+        if network == "KVB" and type == "SUBWAY":
             type = "STR"
 
         # fix "RB RB38", "U U8", … in a lot of regional HAFASes
         if line and line.startswith(type):
             line = line.removeprefix(type)
 
-        for tt in train_types_config["train_types"]:
-            # { type = "IC", line = "1",  line_startswith = "1", network = "SBB"}
-            if (
-                (not "type" in tt or tt["type"].casefold() == type.casefold())
-                and (not "line" in tt or tt["line"] == line)
-                and (
-                    not "line_startswith" in tt
-                    or (line and line.startswith(tt["line_startswith"]))
-                )
-                and (
-                    not "network" in tt
-                    or tt["network"].casefold() == get_network(status).casefold()
-                )
-            ):
-                if "remove_line_startswith" in tt:
-                    line = line.removeprefix(tt["line_startswith"])
-
-                if "fallback" in tt:
-                    line = f"{type} {line or ''}".strip()
-
-                # { emoji = "ica,ic1", color = "#ff0404", hide_line_number = true, always_show_train_number = true }
-                ret = {
-                    "emoji": (ret.get("emoji", "") + " " + emoji(bot, tt)).strip(),
-                    "color": tt.get("color", "#2e2e7d"),
-                    "type": type,
-                    "line": line if not tt.get("hide_line_number") else "",
-                    "number": status["train"]["no"],
-                    "always_show_train_number": tt.get(
-                        "always_show_train_number", False
-                    ),
-                }
-                break
+        # { type = "IC", line = "1",  line_startswith = "1", network = "SBB"}
+        if tt := train_type_index.match(type, line, network):
+            if "remove_line_startswith" in tt:
+                line = line.removeprefix(tt["line_startswith"])
+
+            if "fallback" in tt:
+                line = f"{type} {line or ''}".strip()
+
+            # { emoji = "ica,ic1", color = "#ff0404", hide_line_number = true, always_show_train_number = true }
+            ret = {
+                "emoji": (ret.get("emoji", "") + " " + emoji(bot, tt)).strip(),
+                "color": tt.get("color", "#2e2e7d"),
+                "type": type,
+                "line": line if not tt.get("hide_line_number") else "",
+                "number": status["train"]["no"],
+                "always_show_train_number": tt.get("always_show_train_number", False),
+            }
 
     return ret
 
@@ -588,298 +638,25 @@ def frenchify(name):
     return fullnames.get(stem, stem)
 
 
-def format_travelynx(bot, userid, trips, continue_link=None):
-    """the actual formatting function called by message sends and edits
-    to render an embed describing the current journey"""
-    user = bot.get_user(userid)
-    timezone = DB.User.find(user.id).get_timezone()
-    dt = datetime.fromtimestamp(
-        trips[-1].status["fromStation"]["scheduledTime"], tz=timezone
-    )
-
-    desc = ""
-    color = None
-
-    def _convert_name(name):
-        if translated := DB.CTSStop.translate(name):
-            return translated
-        else:
-            return frenchify(name)
-
-    dt_monthday = (dt.month, dt.day)
-    shouldfrench = dt_monthday == (4, 1) or dt_monthday == (7, 14)
-    if shouldfrench:
-        _conv = _convert_name
-    else:
-        _conv = lambda n: n
-
-    def _next(statuses, current_index):
-        "in the format loop, get the train after the current one or None if we're at the last"
-        if (current_index + 1) < len(statuses):
-            return statuses[current_index + 1]
-        return None
-
-    def _prev(statuses, current_index):
-        "in the format loop, get the train before the current one or None if we're at the first"
-        if (current_index - 1) >= 0:
-            return statuses[current_index - 1]
-        return None
-
-    for i, trip in enumerate(trips):
-        train = trip.status
-        departure = format_time(
-            train["fromStation"]["scheduledTime"],
-            train["fromStation"]["realTime"],
-            timezone=timezone,
-        )
-        display = get_display(bot, train)
-        # compact layout for completed trips
-        if continue_link and _next(trips, i):
-            if not _prev(trips, i):
-                name = _conv(train["fromStation"]["name"])
-                prefix_to_add = replace_city_suffix_with_prefix.get(
-                    name.split(", ")[-1]
-                )
-                if prefix_to_add:
-                    name = f"{prefix_to_add} {', '.join(name.split(', ')[0:-1])}"
-                desc += f"{LineEmoji.COMPACT_JOURNEY_START}{departure} {name}\n"
-                desc += f"{LineEmoji.COMPACT_JOURNEY}{LineEmoji.SPACER}"
-
-            # draw only train type and line number in one line
-            desc += display["emoji"]
-            if display["line"]:
-                desc += f" **{display['line']}**"
-            # draw an arrow to the next trip in the compact section until the last one in the section
-            if _next(trips, i + 1):
-                desc += " → "
-            else:
-                desc += "\n"
-            # ignore the rest of the format loop until we're at the last trip of the journey
-            continue
-
-        # regular layout for full journey display
-        # if we're the first trip of the journey, draw a journey start icon
-        if not _prev(trips, i):
-            name = _conv(train["fromStation"]["name"])
-            prefix_to_add = replace_city_suffix_with_prefix.get(name.split(", ")[-1])
-            if prefix_to_add:
-                name = f"{prefix_to_add} {', '.join(name.split(', ')[0:-1])}"
-            desc += f"{LineEmoji.START}{departure} **{name}**\n"
-        elif prev := _prev(trips, i):
-            prev_train = prev.status
-            # if we've just drawn the last compact mode entry, draw a station
-            if continue_link and not _next(trips, i):
-                desc += f"{LineEmoji.CHANGE_SAME_STOP}{departure} **{train['fromStation']['name']}**\n"
-            # if our trip starts on a different station than the last ended, draw a new station icon
-            elif not is_one_line_change(prev_train["toStation"], train["fromStation"]):
-                station_name = (
-                    merge_names(
-                        prev_train["toStation"]["name"], train["fromStation"]["name"]
-                    )
-                    or train["fromStation"]["name"]
-                )
-                station_name = _conv(
-                    shortened_name(prev_train["toStation"]["name"], station_name)
-                )
-                desc += f"{LineEmoji.CHANGE_ENTER_STOP}{departure} {station_name}\n"
-            # if our trip starts on the same station as the last ended, we've already drawn the change icon
-            else:
-                pass
-
-        route_link = generate_train_link(train)
-
-        headsign = trip.fetch_headsign()
-        # all lines in vienna have overly long HAFAS destinations not consistent with the vehicle display
-        # like "Wien Winckelmannstraße (Schwendergasse 61)" when it should just be Winckelmannstraße
-        if match := re_remove_vienna_suffixes.match(headsign):
-            headsign = _conv(match["name"])
-        headsign = _conv(
-            shortened_name(train["fromStation"]["name"], headsign)
-        )
-
-        headsign = "» " + headsign
-
-        desc += LineEmoji.RAIL + LineEmoji.SPACER + display["emoji"]
-        if route_link:
-            headsign = f"[{headsign}]({route_link})"
-
-        if display["line"]:
-            desc += f" **{display['line']}**"
-        if display["number"] and (
-            display["always_show_train_number"]
-            or DB.User.find(userid).show_train_numbers
-        ):
-            desc += f" {display['number']}"
-        desc += f" **{headsign}**"
-
-        desc += " ●\n" if train["comment"] else "\n"
-        arrival = format_time(
-            train["toStation"]["scheduledTime"],
-            train["toStation"]["realTime"],
-            timezone=timezone,
-        )
-        station_name = _conv(
-            shortened_name(train["fromStation"]["name"], train["toStation"]["name"])
-        )
-        # if we're on the last trip of the journey, draw an end icon
-        if not _next(trips, i):
-            desc += f"{LineEmoji.END}{arrival} **{station_name}**\n"
-
-            if composition := trip.status.get("composition"):
-                desc += f"{LineEmoji.COMPOSITION} {composition}\n"
-
-            trip_time = timedelta(
-                seconds=train["toStation"]["realTime"]
-                - train["fromStation"]["realTime"]
-            )
-            if not trip_time:
-                trip_time += timedelta(seconds=30)
-            desc += f"{LineEmoji.TRIP_SPEED} {format_delta(trip_time)}"
-
-            length = trip_length(trip)
-            if length > 0:
-                desc += (
-                    f" · {length:.1f}{'km+' if trip.hafas_data.get('beeline', True) else 'km'} · "
-                    f"{(length/(trip_time.total_seconds()/3600)):.0f}km/h"
-                )
-            desc += "\n"
-            if messages := trip.hafas_data.get("messages"):
-                messages = messages.copy()
-
-                if stop_messages := trip.hafas_data.get("stop_messages"):
-                    for stop, smessages in stop_messages.items():
-                        messages += smessages
-
-                already = set()
-                for message in messages:
-                    if message["text"] in already or message["text"].startswith(
-                        "Vorankündigung!"
-                    ):
-                        continue
-                    already.add(message["text"])
-
-                    if "type" in message:
-                        # hafas
-                        if message["type"] == "D":
-                            desc += f"{LineEmoji.WARN} {message['text']}\n"
-                        elif (
-                            message["type"] in ("Q", "L") or message.get("code") == "ZN"
-                        ):
-                            if match := re_decompose_him.match(message["text"]):
-                                if "route" in trip.hafas_data and (
-                                    trip.hafas_data["route"][0]["name"] == match["from"]
-                                    and trip.hafas_data["route"][-1]["name"]
-                                    == match["to"]
-                                ):
-                                    desc += f"{LineEmoji.INFO} {match['msg']}\n"
-                                else:
-                                    desc += f"{LineEmoji.INFO} {match['from']} – {match['to']}: {match['msg']}\n"
-                            else:
-                                desc += f"{LineEmoji.INFO} {message['text']}\n"
-                    elif "prioritaet" in message:
-                        # dbris
-                        if message["prioritaet"] == "NIEDRIG":
-                            desc += f"{LineEmoji.INFO} {message['text']}\n"
-                        else:
-                            desc += f"{LineEmoji.WARN} {message['text']}\n"
-
-            if comment := trip.status["comment"]:
-                if len(comment) >= 500:
-                    comment = comment[0:500] + "…"
-                desc += f"{LineEmoji.COMMENT} _{comment}_\n"
-
-        # draw a transfer instead
-        elif next := _next(trips, i):
-            next_train = next.status
-            # if we don't leave the station to change, draw a single change line
-            if is_one_line_change(train["toStation"], next_train["fromStation"]):
-                station_name = (
-                    merge_names(
-                        train["toStation"]["name"], next_train["fromStation"]["name"]
-                    )
-                    or train["toStation"]["name"]
-                )
-                station_name = _conv(
-                    shortened_name(next_train["fromStation"]["name"], station_name)
-                )
-                next_train_departure = format_time(
-                    next_train["fromStation"]["scheduledTime"],
-                    next_train["fromStation"]["realTime"],
-                    timezone=timezone,
-                )
-                desc += f"{LineEmoji.CHANGE_SAME_STOP}{arrival} → {next_train_departure} {station_name}\n"
-            else:
-                # if we leave the station, draw the upper part of a two-line change
-                desc += f"{LineEmoji.CHANGE_LEAVE_STOP}{arrival} " + f"{station_name}\n"
-                train_end_location = (
-                    train["toStation"]["latitude"],
-                    train["toStation"]["longitude"],
-                )
-                next_train_start_location = (
-                    next_train["fromStation"]["latitude"],
-                    next_train["fromStation"]["longitude"],
-                )
-                change_meters = haversine(
-                    train_end_location, next_train_start_location, unit="m"
-                )
-                if change_meters > 200.0 and not any(
-                    lat == lon == 0.0
-                    for (lat, lon) in [train_end_location, next_train_start_location]
-                ):
-                    desc += f"{LineEmoji.CHANGE_WALK}{LineEmoji.SPACER}*— {int(change_meters)} m —*\n"
-
-        # overwrite last set embed color with the current color
-        color = discord.Color.from_str(display["color"])
-
-    # end of format loop, finish up embed
-
-    if continue_link:
-        desc += f"\n{LineEmoji.DESTINATION} {continue_link}\n"
-    else:
-        to_time = format_time(
-            trips[-1].status["toStation"]["scheduledTime"],
-            trips[-1].status["toStation"]["realTime"],
-            True,
-        )
-        desc += f"\n{LineEmoji.DESTINATION} **{_conv(trips[-1].status['toStation']['name'])} {to_time}**\n"
-
-    total_time = timedelta(
-        seconds=trips[-1].status["toStation"]["realTime"]
-        - trips[0].status["fromStation"]["realTime"]
-    )
-    if not total_time:
-        total_time += timedelta(seconds=30)
-    journey_time = timedelta(
-        seconds=sum(
-            trip.status["toStation"]["realTime"]
-            - trip.status["fromStation"]["realTime"]
-            for trip in trips
-        )
-    )
-    if not journey_time:
-        journey_time += timedelta(seconds=30)
-    lengths = [
-        trip_length(DB.Trip.find(user.id, zugid(trip.get_unpatched_status())))
-        for trip in trips
-    ]
-    includes_beelines = any(l == 0 for l in lengths) or any(
-        DB.Trip.find(user.id, zugid(trip.get_unpatched_status())).hafas_data.get(
-            "beeline", True
-        )
-        for trip in trips
-    )
-    desc += (
-        f"{LineEmoji.TRIP_SUM} {len(trips)} {'trip' if len(trips) == 1 else 'trips'} · "
-        f"{format_delta(total_time)} ({format_delta(journey_time)} in transit) · "
-        f"{sum(lengths):.1f}km{'+' if includes_beelines else ''} · "
-        f"{sum(lengths)/(total_time.total_seconds()/3600):.0f}km/h\n"
-    )
-    desc += (
-        f"-# {format_timezone(timezone)} · "
-        + f"{trip.status['backend']['name'] or 'DB'} {trip.status['backend']['type']}"
-    )
-
-    map_link = None
+@dataclass
+class RenderContext:
+    "everything rendering a journey needs from the database, see build_render_context()"
+    bot: discord.Client
+    user: discord.User
+    timezone: ZoneInfo
+    show_train_numbers: bool
+    trips: list
+    continue_link: Optional[str]
+    displays: list
+    lengths: list
+    route_links: list
+    map_link: Optional[str]
+    copy_link: Optional[str]
+
+
+def journey_map_url(trip):
+    "where the map link at the end of the embed goes, if it has one"
+    map_url = None
     # hafas id, either from travelynx backend directly or via our own hafas data
     if (jid := trip.hafas_data.get("id", trip.status["train"]["id"])) and (
         "#" in jid or "|" in jid
@@ -896,7 +673,7 @@ def format_travelynx(bot, userid, trips, continue_link=None):
             jid = urllib.parse.quote(trip.status["train"]["id"])
             hafas = "&dbris=bahn.de"
 
-        map_link = DB.Link.make(
+        map_url = (
             f"https://dbf.finalrewind.org/map/{jid}/0?hafas={hafas}"
             + f"&from={from_station}&to={to_station}"
         )
@@ -909,19 +686,20 @@ def format_travelynx(bot, userid, trips, continue_link=None):
         motis_id = urllib.parse.quote(trip.status["train"]["id"])
         from_station = urllib.parse.quote(trip.status["fromStation"]["name"])
         to_station = urllib.parse.quote(trip.status["toStation"]["name"])
-        map_link = DB.Link.make(
+        map_url = (
             f"https://dbf.finalrewind.org/map/{motis_id}/0?motis={map_backend}"
             + f"&from={from_station}&to={to_station}"
         )
     elif trip.status["backend"]["type"] == "EFA":
         jid = urllib.parse.quote(trip.status["train"]["id"])
-        map_link = DB.Link.make(
+        map_url = (
             f"https://dbf.finalrewind.org/map/{jid}/0?efa={trip.status['backend']['name']}"
         )
+    return map_url
 
-    if map_link:
-        desc += f" · [Map]({config['shortener_url']}/{map_link.short_id})"
 
+def journey_copy_url(trip):
+    "where the copy link at the end of the embed goes, to check into the same trip"
     backend = trip.status["backend"]
     copy_url = config["travelynx_instance"]
     if backend["type"] == "IRIS-TTS":
@@ -970,10 +748,443 @@ def format_travelynx(bot, userid, trips, continue_link=None):
         )
     else:
         copy_url = None
+    return copy_url
+
+
+def journey_urls(trips):
+    "the route link for every trip and the map and copy links, None where there's none"
+    route_urls = [train_link_url(trip.status, trip.hafas_data) for trip in trips]
+    return route_urls, journey_map_url(trips[-1]), journey_copy_url(trips[-1])
+
+
+def journey_link_urls(trips):
+    "every url the embed for trips makes a short link for"
+    route_urls, map_url, copy_url = journey_urls(trips)
+    return {url for url in (*route_urls, map_url, copy_url) if url}
+
+
+def make_journey_links(trips):
+    "make short links for everything the embed for trips links to"
+    return DB.Link.make_all(list(journey_link_urls(trips)))
+
+
+def build_render_context(bot, userid, trips, continue_link=None):
+    """load everything rendering these trips needs at once: the user's settings, the
+    polylines of all trips and all links the embed shows, creating the ones that are new"""
+    db_user = DB.User.find(userid)
+    polylines = DB.Polyline.find_all(userid, [trip.journey_id for trip in trips])
+    route_urls, map_url, copy_url = journey_urls(trips)
+    links = make_journey_links(trips)
+
+    def short(url):
+        if url:
+            return f"{config['shortener_url']}/{links[url].short_id}"
+        return None
+
+    return RenderContext(
+        bot=bot,
+        user=bot.get_user(userid),
+        timezone=db_user.get_timezone(),
+        show_train_numbers=db_user.show_train_numbers,
+        trips=trips,
+        continue_link=continue_link,
+        displays=[get_display(bot, trip.status, trip.get_network()) for trip in trips],
+        lengths=[trip_length(trip, polylines) for trip in trips],
+        route_links=[short(url) for url in route_urls],
+        map_link=short(map_url),
+        copy_link=short(copy_url),
+    )
+
+
+def format_travelynx(bot, userid, trips, continue_link=None):
+    """the actual formatting function called by message sends and edits
+    to render an embed describing the current journey"""
+
+    def render():
+        return render_journey(build_render_context(bot, userid, trips, continue_link))
+
+    # a webhook posting to several live channels renders the same trips every time.
+    # trips can change in place when they get refreshed, so they're identified by
+    # their etags, which cover everything rendering them reads
+    embed = DB.identity(
+        (
+            "render",
+            userid,
+            tuple(trip_etags(trip)[1] for trip in trips),
+            continue_link,
+        ),
+        render,
+    )
+    return embed.copy()
+
+
+async def aformat_travelynx(bot, userid, trips, continue_link=None):
+    """format_travelynx off the event loop. new links get made in the db writer thread
+    first, so rendering in a reader thread only has to read. within a unit of work we
+    remember which links we made already, posting to several channels only needs them once"""
+    made = DB.identity(("links made",), set)
+    if not (urls := journey_link_urls(trips)) <= made:
+        await DB.write(make_journey_links, trips)
+        made |= urls
+    return await DB.read(
+        format_travelynx, bot, userid, trips, continue_link=continue_link
+    )
+
+
+# rendered trips, keyed by fragment_key(). a journey that gets rerendered on every status
+# update usually only has its last trip changed, so only that one gets rendered again
+fragment_cache = LRUCache(
+    config.get("fragment_cache_size", 4096), enabled=config.get("fragment_cache", True)
+)
+
+
+def convert_name(name):
+    "what a station is called on april fools and bastille day"
+    if translated := DB.CTSStop.translate(name):
+        return translated
+    return frenchify(name)
+
+
+def _next(statuses, current_index):
+    "in the format loop, get the train after the current one or None if we're at the last"
+    if (current_index + 1) < len(statuses):
+        return statuses[current_index + 1]
+    return None
+
+def _prev(statuses, current_index):
+    "in the format loop, get the train before the current one or None if we're at the first"
+    if (current_index - 1) >= 0:
+        return statuses[current_index - 1]
+    return None
+
+
+def trip_etags(trip):
+    """hashes of what rendering a trip reads from it: one of just the (already patched)
+    status for its neighbours' transfers, one of that plus the hafas data we show and
+    the train types config for the trip itself"""
+    status = hashlib.blake2b(
+        json.dumps(trip.status, sort_keys=True).encode(), digest_size=16
+    ).digest()
+    hafas_data = trip.hafas_data
+    route = hafas_data.get("route") or [{}]
+    shown_hafas_data = json.dumps(
+        [
+            hafas_data.get("headsign"),
+            hafas_data.get("beeline", True),
+            hafas_data.get("messages"),
+            hafas_data.get("stop_messages"),
+            route[0].get("name"),
+            route[-1].get("name"),
+        ],
+        sort_keys=True,
+    ).encode()
+    trip_etag = hashlib.blake2b(
+        status + shown_hafas_data + train_types_version, digest_size=16
+    ).digest()
+    return status, trip_etag
+
+
+def fragment_key(ctx, i, etags, shouldfrench):
+    "everything render_trip(ctx, i, ...) depends on"
+    return (
+        etags[i][1],
+        etags[i - 1][0] if i > 0 else None,
+        etags[i + 1][0] if i + 1 < len(etags) else None,
+        i + 2 < len(etags),
+        bool(ctx.continue_link),
+        str(ctx.timezone),
+        shouldfrench,
+        ctx.show_train_numbers,
+        ctx.route_links[i],
+        json.dumps(ctx.displays[i], sort_keys=True),
+        ctx.lengths[i],
+    )
+
+
+def render_trip(ctx, i, _conv):
+    """the part of the journey embed that belongs to ctx.trips[i], from its departure up to
+    the transfer to the next trip. only reads what fragment_key() covers"""
+    trips = ctx.trips
+    timezone = ctx.timezone
+    continue_link = ctx.continue_link
+    trip = trips[i]
+    desc = ""
+    train = trip.status
+    departure = format_time(
+        train["fromStation"]["scheduledTime"],
+        train["fromStation"]["realTime"],
+        timezone=timezone,
+    )
+    display = ctx.displays[i]
+    # compact layout for completed trips
+    if continue_link and _next(trips, i):
+        if not _prev(trips, i):
+            name = _conv(train["fromStation"]["name"])
+            prefix_to_add = replace_city_suffix_with_prefix.get(
+                name.split(", ")[-1]
+            )
+            if prefix_to_add:
+                name = f"{prefix_to_add} {', '.join(name.split(', ')[0:-1])}"
+            desc += f"{LineEmoji.COMPACT_JOURNEY_START}{departure} {name}\n"
+            desc += f"{LineEmoji.COMPACT_JOURNEY}{LineEmoji.SPACER}"
+
+        # draw only train type and line number in one line
+        desc += display["emoji"]
+        if display["line"]:
+            desc += f" **{display['line']}**"
+        # draw an arrow to the next trip in the compact section until the last one in the section
+        if _next(trips, i + 1):
+            desc += " → "
+        else:
+            desc += "\n"
+        # ignore the rest of the format loop until we're at the last trip of the journey
+        return desc
+
+    # regular layout for full journey display
+    # if we're the first trip of the journey, draw a journey start icon
+    if not _prev(trips, i):
+        name = _conv(train["fromStation"]["name"])
+        prefix_to_add = replace_city_suffix_with_prefix.get(name.split(", ")[-1])
+        if prefix_to_add:
+            name = f"{prefix_to_add} {', '.join(name.split(', ')[0:-1])}"
+        desc += f"{LineEmoji.START}{departure} **{name}**\n"
+    elif prev := _prev(trips, i):
+        prev_train = prev.status
+        # if we've just drawn the last compact mode entry, draw a station
+        if continue_link and not _next(trips, i):
+            desc += f"{LineEmoji.CHANGE_SAME_STOP}{departure} **{train['fromStation']['name']}**\n"
+        # if our trip starts on a different station than the last ended, draw a new station icon
+        elif not is_one_line_change(prev_train["toStation"], train["fromStation"]):
+            station_name = (
+                merge_names(
+                    prev_train["toStation"]["name"], train["fromStation"]["name"]
+                )
+                or train["fromStation"]["name"]
+            )
+            station_name = _conv(
+                shortened_name(prev_train["toStation"]["name"], station_name)
+            )
+            desc += f"{LineEmoji.CHANGE_ENTER_STOP}{departure} {station_name}\n"
+        # if our trip starts on the same station as the last ended, we've already drawn the change icon
+        else:
+            pass
+
+    route_link = ctx.route_links[i]
+
+    headsign = trip.fetch_headsign()
+    # all lines in vienna have overly long HAFAS destinations not consistent with the vehicle display
+    # like "Wien Winckelmannstraße (Schwendergasse 61)" when it should just be Winckelmannstraße
+    if match := re_remove_vienna_suffixes.match(headsign):
+        headsign = _conv(match["name"])
+    headsign = _conv(
+        shortened_name(train["fromStation"]["name"], headsign)
+    )
+
+    headsign = "» " + headsign
+
+    desc += LineEmoji.RAIL + LineEmoji.SPACER + display["emoji"]
+    if route_link:
+        headsign = f"[{headsign}]({route_link})"
+
+    if display["line"]:
+        desc += f" **{display['line']}**"
+    if display["number"] and (
+        display["always_show_train_number"]
+        or ctx.show_train_numbers
+    ):
+        desc += f" {display['number']}"
+    desc += f" **{headsign}**"
+
+    desc += " ●\n" if train["comment"] else "\n"
+    arrival = format_time(
+        train["toStation"]["scheduledTime"],
+        train["toStation"]["realTime"],
+        timezone=timezone,
+    )
+    station_name = _conv(
+        shortened_name(train["fromStation"]["name"], train["toStation"]["name"])
+    )
+    # if we're on the last trip of the journey, draw an end icon
+    if not _next(trips, i):
+        desc += f"{LineEmoji.END}{arrival} **{station_name}**\n"
+
+        if composition := trip.status.get("composition"):
+            desc += f"{LineEmoji.COMPOSITION} {composition}\n"
+
+        trip_time = timedelta(
+            seconds=train["toStation"]["realTime"]
+            - train["fromStation"]["realTime"]
+        )
+        if not trip_time:
+            trip_time += timedelta(seconds=30)
+        desc += f"{LineEmoji.TRIP_SPEED} {format_delta(trip_time)}"
+
+        length = ctx.lengths[i]
+        if length > 0:
+            desc += (
+                f" · {length:.1f}{'km+' if trip.hafas_data.get('beeline', True) else 'km'} · "
+                f"{(length/(trip_time.total_seconds()/3600)):.0f}km/h"
+            )
+        desc += "\n"
+        if messages := trip.hafas_data.get("messages"):
+            messages = messages.copy()
+
+            if stop_messages := trip.hafas_data.get("stop_messages"):
+                for stop, smessages in stop_messages.items():
+                    messages += smessages
+
+            already = set()
+            for message in messages:
+                if message["text"] in already or message["text"].startswith(
+                    "Vorankündigung!"
+                ):
+                    continue
+                already.add(message["text"])
+
+                if "type" in message:
+                    # hafas
+                    if message["type"] == "D":
+                        desc += f"{LineEmoji.WARN} {message['text']}\n"
+                    elif (
+                        message["type"] in ("Q", "L") or message.get("code") == "ZN"
+                    ):
+                        if match := re_decompose_him.match(message["text"]):
+                            if "route" in trip.hafas_data and (
+                                trip.hafas_data["route"][0]["name"] == match["from"]
+                                and trip.hafas_data["route"][-1]["name"]
+                                == match["to"]
+                            ):
+                                desc += f"{LineEmoji.INFO} {match['msg']}\n"
+                            else:
+                                desc += f"{LineEmoji.INFO} {match['from']} – {match['to']}: {match['msg']}\n"
+                        else:
+                            desc += f"{LineEmoji.INFO} {message['text']}\n"
+                elif "prioritaet" in message:
+                    # dbris
+                    if message["prioritaet"] == "NIEDRIG":
+                        desc += f"{LineEmoji.INFO} {message['text']}\n"
+                    else:
+                        desc += f"{LineEmoji.WARN} {message['text']}\n"
+
+        if comment := trip.status["comment"]:
+            if len(comment) >= 500:
+                comment = comment[0:500] + "…"
+            desc += f"{LineEmoji.COMMENT} _{comment}_\n"
+
+    # draw a transfer instead
+    elif next := _next(trips, i):
+        next_train = next.status
+        # if we don't leave the station to change, draw a single change line
+        if is_one_line_change(train["toStation"], next_train["fromStation"]):
+            station_name = (
+                merge_names(
+                    train["toStation"]["name"], next_train["fromStation"]["name"]
+                )
+                or train["toStation"]["name"]
+            )
+            station_name = _conv(
+                shortened_name(next_train["fromStation"]["name"], station_name)
+            )
+            next_train_departure = format_time(
+                next_train["fromStation"]["scheduledTime"],
+                next_train["fromStation"]["realTime"],
+                timezone=timezone,
+            )
+            desc += f"{LineEmoji.CHANGE_SAME_STOP}{arrival} → {next_train_departure} {station_name}\n"
+        else:
+            # if we leave the station, draw the upper part of a two-line change
+            desc += f"{LineEmoji.CHANGE_LEAVE_STOP}{arrival} " + f"{station_name}\n"
+            train_end_location = (
+                train["toStation"]["latitude"],
+                train["toStation"]["longitude"],
+            )
+            next_train_start_location = (
+                next_train["fromStation"]["latitude"],
+                next_train["fromStation"]["longitude"],
+            )
+            change_meters = haversine(
+                train_end_location, next_train_start_location, unit="m"
+            )
+            if change_meters > 200.0 and not any(
+                lat == lon == 0.0
+                for (lat, lon) in [train_end_location, next_train_start_location]
+            ):
+                desc += f"{LineEmoji.CHANGE_WALK}{LineEmoji.SPACER}*— {int(change_meters)} m —*\n"
+    return desc
+
+
+def render_journey(ctx):
+    "render the embed for a journey only from what's in ctx, without asking the database"
+    user = ctx.user
+    timezone = ctx.timezone
+    trips = ctx.trips
+    continue_link = ctx.continue_link
+    dt = datetime.fromtimestamp(
+        trips[-1].status["fromStation"]["scheduledTime"], tz=timezone
+    )
+
+    desc = ""
+
+    dt_monthday = (dt.month, dt.day)
+    shouldfrench = dt_monthday == (4, 1) or dt_monthday == (7, 14)
+    _conv = convert_name if shouldfrench else lambda n: n
+
+    etags = [trip_etags(trip) for trip in trips]
+    for i in range(len(trips)):
+        desc += fragment_cache.get(
+            fragment_key(ctx, i, etags, shouldfrench),
+            lambda: render_trip(ctx, i, _conv),
+        )
+    # the last trip never is in the compact section, so its color is the one we want
+    color = discord.Color.from_str(ctx.displays[-1]["color"])
+
+    # end of format loop, finish up embed
+
+    if continue_link:
+        desc += f"\n{LineEmoji.DESTINATION} {continue_link}\n"
+    else:
+        to_time = format_time(
+            trips[-1].status["toStation"]["scheduledTime"],
+            trips[-1].status["toStation"]["realTime"],
+            True,
+        )
+        desc += f"\n{LineEmoji.DESTINATION} **{_conv(trips[-1].status['toStation']['name'])} {to_time}**\n"
+
+    total_time = timedelta(
+        seconds=trips[-1].status["toStation"]["realTime"]
+        - trips[0].status["fromStation"]["realTime"]
+    )
+    if not total_time:
+        total_time += timedelta(seconds=30)
+    journey_time = timedelta(
+        seconds=sum(
+            trip.status["toStation"]["realTime"]
+            - trip.status["fromStation"]["realTime"]
+            for trip in trips
+        )
+    )
+    if not journey_time:
+        journey_time += timedelta(seconds=30)
+    lengths = ctx.lengths
+    includes_beelines = any(l == 0 for l in lengths) or any(
+        trip.hafas_data.get("beeline", True) for trip in trips
+    )
+    desc += (
+        f"{LineEmoji.TRIP_SUM} {len(trips)} {'trip' if len(trips) == 1 else 'trips'} · "
+        f"{format_delta(total_time)} ({format_delta(journey_time)} in transit) · "
+        f"{sum(lengths):.1f}km{'+' if includes_beelines else ''} · "
+        f"{sum(lengths)/(total_time.total_seconds()/3600):.0f}km/h\n"
+    )
+    desc += (
+        f"-# {format_timezone(timezone)} · "
+        + f"{trips[-1].status['backend']['name'] or 'DB'} {trips[-1].status['backend']['type']}"
+    )
+
+    if ctx.map_link:
+        desc += f" · [Map]({ctx.map_link})"
 
-    if copy_url:
-        copy_link = DB.Link.make(copy_url)
-        desc += f" · [Copy]({config['shortener_url']}/{copy_link.short_id})"
+    if ctx.copy_link:
+        desc += f" · [Copy]({ctx.copy_link})"
 
     if shouldfrench:
         embed_title = f"Mon dieu! L'{user.name}, c'{'était' if not trips[-1].status['checkedIn'] else 'est'} en route"
@@ -1003,19 +1214,21 @@ def format_travelynx(bot, userid, trips, continue_link=None):
         icon_url=user.avatar.url,
     )
 
-    embed = sillies(bot, trips, embed)
+    embed = sillies(ctx, embed)
 
     return embed
 
 
-def sillies(bot, trips, embed):
+def sillies(ctx, embed):
     "do funny things with the embed once it's done"
+    trips = ctx.trips
 
     # sort by "S"+"31", ie train type and line
     # actually sort by emoji+line since the line field is empty on some supported
     # transit networks, so it would count combos for the same train type and ignore the lines
     sortkey = lambda d: f"{d['emoji']}{d['line']}"
-    train_lines = sorted([get_display(bot, trip.status) for trip in trips], key=sortkey)
+    # copies, since we append to the line of the one we show
+    train_lines = sorted([dict(d) for d in ctx.displays], key=sortkey)
     grouped = []
     for _, group in groupby(train_lines, key=sortkey):
         grouped.append(list(group))
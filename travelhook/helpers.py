@@ -1,15 +1,17 @@
 "various helper functions that do more than just pure formatting logic. the icon library lives in here too"
+import collections
 from datetime import datetime, timedelta
 from zoneinfo import available_timezones, ZoneInfo
 import json
 import random
 import re
 import string
+import threading
 import traceback
 import urllib
 
 import discord
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from haversine import haversine
 
 from . import database as DB
@@ -25,6 +27,45 @@ def zugid(data):
     return f'{data["train"]["id"]}:{data["fromStation"]["scheduledTime"]}'
 
 
+class LRUCache:
+    """a bounded cache that throws out whatever was used the longest time ago once it's full.
+    load() runs outside the lock, so a slow query doesn't hold up everyone else, and if the
+    key gets invalidated in the meantime we don't keep what it returned."""
+
+    def __init__(self, size, enabled=True):
+        self.size = size
+        self.enabled = enabled and size > 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        if not self.enabled:
+            return load()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            generation = self.generation
+        value = load()
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = value
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(key, None)
+
+
 # globally used timezone
 tz = ZoneInfo("Europe/Berlin")
 available_tzs = available_timezones()
@@ -65,52 +106,77 @@ def parse_manual_time(time, timezone):
         )
 
 
+http_session = None
+
+
+def get_session():
+    """the aiohttp session for all our outgoing requests, so we get to keep connections
+    and dns lookups around instead of starting from scratch for every single request"""
+    global http_session
+    if not http_session or http_session.closed:
+        http_session = ClientSession(
+            connector=TCPConnector(
+                limit=config.get("http_connections", 100),
+                limit_per_host=config.get("http_connections_per_host", 8),
+                ttl_dns_cache=300,
+            ),
+            timeout=ClientTimeout(
+                total=config.get("http_timeout", 20),
+                connect=config.get("http_connect_timeout", 5),
+            ),
+        )
+    return http_session
+
+
+async def close_session():
+    if http_session and not http_session.closed:
+        await http_session.close()
+
+
 async def is_token_valid(token):
     "check if a status api token actually works"
-    async with ClientSession() as session:
-        async with session.get(
-            f"{config['travelynx_instance']}/api/v1/status/{token}"
-        ) as r:
-            try:
-                data = await r.json()
-                if r.status == 200 and not "error" in data:
-                    return True
-                print(f"token {token} invalid: {r.status} {data}")
-                return False
-            except:  # pylint: disable=bare-except
-                print(f"error verifying token {token}:")
-                traceback.print_exc()
+    async with get_session().get(
+        f"{config['travelynx_instance']}/api/v1/status/{token}"
+    ) as r:
+        try:
+            data = await r.json()
+            if r.status == 200 and not "error" in data:
+                return True
+            print(f"token {token} invalid: {r.status} {data}")
+            return False
+        except:  # pylint: disable=bare-except
+            print(f"error verifying token {token}:")
+            traceback.print_exc()
 
 
 async def is_import_token_valid(token):
     "check if a import api token actually works"
-    async with ClientSession() as session:
-        async with session.post(
-            f"{config['travelynx_instance']}/api/v1/import",
-            json={
-                "token": token,
-                "dryRun": True,
-                "train": {
-                    "type": "S",
-                    "line": "6",
-                    "no": "30634",
-                },
-                "fromStation": {"name": "Essen Hbf", "scheduledTime": 1556083680},
-                "toStation": {"name": "Essen Stadtwald", "scheduledTime": 1556083980},
-                "intermediateStops": [
-                    "Essen Süd",
-                ],
+    async with get_session().post(
+        f"{config['travelynx_instance']}/api/v1/import",
+        json={
+            "token": token,
+            "dryRun": True,
+            "train": {
+                "type": "S",
+                "line": "6",
+                "no": "30634",
             },
-        ) as r:
-            try:
-                data = await r.json()
-                if r.status == 200 and not "error" in data:
-                    return True
-                print(f"token {token} invalid: {r.status} {data}")
-                return False
-            except:  # pylint: disable=bare-except
-                print(f"error verifying token {token}:")
-                traceback.print_exc()
+            "fromStation": {"name": "Essen Hbf", "scheduledTime": 1556083680},
+            "toStation": {"name": "Essen Stadtwald", "scheduledTime": 1556083980},
+            "intermediateStops": [
+                "Essen Süd",
+            ],
+        },
+    ) as r:
+        try:
+            data = await r.json()
+            if r.status == 200 and not "error" in data:
+                return True
+            print(f"token {token} invalid: {r.status} {data}")
+            return False
+        except:  # pylint: disable=bare-except
+            print(f"error verifying token {token}:")
+            traceback.print_exc()
 
 
 def format_time(sched, actual, relative=False, timezone=tz):
@@ -169,6 +235,13 @@ def generate_train_link(data):
     else:
         hafas_data = {}
 
+    if link := train_link_url(data, hafas_data):
+        link = DB.Link.make(link)
+        return f"{config['shortener_url']}/{link.short_id}"
+
+
+def train_link_url(data, hafas_data):
+    "the long url generate_train_link() makes a short link for, if there's one"
     link = None
     # if train starts in germany and is a "real train" (said in an offensively gatekeepy way. just to be clear.)
     # bahn.expert may have confirmed realtime data for it -- construct a link with the train number
@@ -215,10 +288,7 @@ def generate_train_link(data):
     else:
         link = None
 
-    link = data.get("link", link)
-    if link:
-        link = DB.Link.make(link)
-        return f"{config['shortener_url']}/{link.short_id}"
+    return data.get("link", link)
 
 
 def format_composition_element(element):
@@ -239,35 +309,24 @@ def format_composition_element(element):
     return element
 
 
-def trip_length(trip):
+def trip_length(trip, polylines=None):
+    """polylines can be what DB.Polyline.find_all() returned for the trip's user,
+    so we don't have to look up the polyline for every trip on its own"""
     if dist := trip.status.get("distance"):
         return dist
 
-    trip_length = 0
+    if polylines is not None:
+        polyline = polylines.get(trip.journey_id)
+    else:
+        polyline = DB.Polyline.find(trip.user_id, trip.journey_id)
+    if polyline:
+        return polyline.length(trip.status["fromStation"], trip.status["toStation"])
+    # trips we got hafas data for before polylines got their own table
     if polyline := trip.hafas_data.get("polyline"):
-        trip_started = False
-        for i, point in enumerate(polyline):
-            if (
-                point["eva"] == trip.status["fromStation"]["uic"]
-                or point["name"] == trip.status["fromStation"]["name"]
-            ):
-                trip_started = True
-            if (
-                point["eva"] == trip.status["toStation"]["uic"]
-                or point["name"] == trip.status["toStation"]["name"]
-                or i + 1 == len(polyline)
-            ):
-                break
-            if trip_started:
-                trip_length += haversine(
-                    (point["lat"], point["lon"]),
-                    (
-                        polyline[i + 1]["lat"],
-                        polyline[i + 1]["lon"],
-                    ),
-                )
-
-    return trip_length
+        return DB.Polyline.from_hafas(trip.user_id, trip.journey_id, polyline).length(
+            trip.status["fromStation"], trip.status["toStation"]
+        )
+    return 0
 
 
 def fetch_headsign(status):
@@ -277,7 +336,7 @@ def fetch_headsign(status):
         return fhs
 
     if cached := DB.DB.execute(
-        "SELECT headsign, json_patch(travelynx_status, status_patch) as status "
+        "SELECT headsign, patched_status as status "
         "FROM trips WHERE journey_id = ?",
         (zugid(status),),
     ).fetchone():
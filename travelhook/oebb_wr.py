@@ -3,9 +3,8 @@ import datetime
 import re
 import traceback
 
-from aiohttp import ClientSession
-
 from . import database as DB
+from .helpers import get_session
 
 match_data = {
     # 1016 could also be 1116
@@ -268,33 +267,32 @@ def get_station_no(name: str):
 
 
 async def get_composition(train_no: int, station_no: int, departure: datetime.datetime):
-    async with ClientSession() as session:
-        url = f"https://live.oebb.at/backend/info?trainNr={train_no}&station={station_no}&date={departure:%Y-%m-%d}&time={departure:%H%%3A%M}"
-        async with session.get(url) as r:
-            try:
-                data = await r.json()
-                if not r.status == 200 or not "train" in data:
-                    print(
-                        f"ÖBB Live {train_no} from {station_no} at {departure:%d-%m-%Y %H:%M} returned no data: {r.status} {data}\n{url}"
-                    )
-                    return None
-                wagons = data["train"]["wagons"]
-                composition = []
-                while wagons:
-                    for class_name, match_slice in match_data.items():
-                        wagons_slice = wagons[: len(match_slice)]
-                        if match_wagons_slice(match_slice, wagons_slice):
-                            composition.append(
-                                {"class_name": class_name, "wagons": wagons_slice}
-                            )
-                            wagons = wagons[len(match_slice) :]
-                            break
-
-                return composition
-
-            except:  # pylint: disable=bare-except
+    url = f"https://live.oebb.at/backend/info?trainNr={train_no}&station={station_no}&date={departure:%Y-%m-%d}&time={departure:%H%%3A%M}"
+    async with get_session().get(url) as r:
+        try:
+            data = await r.json()
+            if not r.status == 200 or not "train" in data:
                 print(
-                    f"ÖBB Live {train_no} from {station_no} at {departure:%d-%m-%Y %H:%M} failed:\n{url}"
+                    f"ÖBB Live {train_no} from {station_no} at {departure:%d-%m-%Y %H:%M} returned no data: {r.status} {data}\n{url}"
                 )
-                traceback.print_exc()
                 return None
+            wagons = data["train"]["wagons"]
+            composition = []
+            while wagons:
+                for class_name, match_slice in match_data.items():
+                    wagons_slice = wagons[: len(match_slice)]
+                    if match_wagons_slice(match_slice, wagons_slice):
+                        composition.append(
+                            {"class_name": class_name, "wagons": wagons_slice}
+                        )
+                        wagons = wagons[len(match_slice) :]
+                        break
+
+            return composition
+
+        except Exception:  # pylint: disable=broad-exception-caught
+            print(
+                f"ÖBB Live {train_no} from {station_no} at {departure:%d-%m-%Y %H:%M} failed:\n{url}"
+            )
+            traceback.print_exc()
+            return None